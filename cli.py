@@ -0,0 +1,275 @@
+"""
+Command line interface of ForestPicTaker, for running the segmentation without the GUI.
+
+Examples:
+    python cli.py benchmark image.jpg labels.png
+    python cli.py segment image.jpg labels.png --classifier ExtraTrees -o result.png
+    python cli.py autotune image.jpg labels.png
+    python cli.py segment image.jpg labels.png --export-model model.joblib
+    python cli.py watch model.joblib /media/drone/DCIM
+    python cli.py evaluate model.joblib images/ ground_truth/
+    python cli.py worker model.joblib /mnt/nfs/flight_01
+    python cli.py serve --model forest=model.joblib
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from skimage import io
+
+import weka as wk
+import stream
+import evaluate
+import jobqueue
+import server
+
+
+def load_labels(path):
+    """
+    Load a label mask (0 = unlabelled, 1..n = categories)
+    :param path: path of a single-channel image
+    :return: numpy array (uint8)
+    """
+    labels = io.imread(path)
+    if labels.ndim == 3:
+        labels = labels[..., 0]
+    return labels.astype(np.uint8)
+
+
+def load_inputs(args):
+    img = wk.rgba2rgb(io.imread(args.image))
+    labels = load_labels(args.labels)
+    if labels.shape != img.shape[:2]:
+        sys.exit(f'labels shape {labels.shape} does not match image shape {img.shape[:2]}')
+    return img, labels
+
+
+def cmd_benchmark(args):
+    img, labels = load_inputs(args)
+    params = dict(wk.DEFAULT_FEATURE_PARAMS, banks=tuple(args.banks))
+    plan = wk.plan_memory(img.shape, params, n_classes=labels.max(), budget=args.memory)
+    if plan['tile_size'] is not None:
+        sys.exit('the features of this image do not fit in the memory budget, use a crop of the image')
+    features = wk.get_features_func(**params)(img)
+    try:
+        reports = wk.benchmark_classifiers(labels, features, names=args.classifiers)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    print(f"{'classifier':<22}{'accuracy':>10}{'fit [s]':>10}{'pixels/s':>12}{'fit [MB]':>10}{'model [MB]':>12}")
+    for r in reports:
+        print(f"{r['name']:<22}{r['accuracy']:>10.3f}{r['fit_time']:>10.2f}{r['pixels_per_s']:>12.3g}"
+              f"{r['fit_memory_mb']:>10.1f}{r['model_size_mb']:>12.2f}")
+
+
+def cmd_segment(args):
+    img, labels = load_inputs(args)
+    try:
+        clf, features_func, result = wk.weka_segment(img, labels, classifier=args.classifier, banks=args.banks,
+                                                     memory_budget=args.memory)
+    except wk.MemoryBudgetError as e:
+        sys.exit(str(e))
+    stream.save_segmentation(result, args.output)
+    print(f'segmentation saved to {args.output}')
+    if args.export_model:
+        wk.export_model(args.export_model, clf, features_func)
+        print(f'model saved to {args.export_model}')
+
+
+def cmd_watch(args):
+    clf, features_func = wk.load_model(args.model)
+    out_folder = args.output or os.path.join(args.folder, 'ForestPicTaker_outputs')
+    streamer = stream.StreamingSegmenter(clf, features_func, out_folder, queue_size=args.queue_size,
+                                         memory_budget=args.memory, output=args.output_mode)
+    streamer.watch(args.folder, interval=args.interval, stable_checks=args.stable_checks)
+    print(f'watching {args.folder}, press Ctrl+C to stop')
+    try:
+        while True:
+            time.sleep(args.report)
+            st = streamer.stats()
+            print(f"{st['processed']} segmented, {st['failed']} failed, {st['images_per_min']:.1f} img/min, "
+                  f"{st['megapixels_per_s']:.2f} MP/s, queued {st['queued']}")
+    except KeyboardInterrupt:
+        print('stopping, finishing the images in the pipeline...')
+        streamer.stop()
+
+
+def cmd_worker(args):
+    clf, features_func = wk.load_model(args.model)
+    queue = jobqueue.JobQueue(args.folder, args.queue, lease_ttl=args.lease_ttl)
+    out_folder = args.output or os.path.join(args.folder, 'ForestPicTaker_outputs')
+    worker = jobqueue.Worker(queue, clf, features_func, out_folder, worker_id=args.worker_id,
+                             memory_budget=args.memory, output=args.output_mode)
+    print(f'worker {worker.worker_id} started on {args.folder}')
+    try:
+        worker.run(follow=args.follow, poll_interval=args.interval)
+    except KeyboardInterrupt:
+        print('stopped')
+    print(f"{worker.stats['processed']} images segmented, {worker.stats['failed']} failed")
+
+
+def cmd_queue_status(args):
+    queue = jobqueue.JobQueue(args.folder, args.queue, lease_ttl=args.lease_ttl)
+    status = queue.status()
+    print(f"done: {status['done']}, in progress: {status['leased']}, stale: {status['stale']}, "
+          f"pending: {status['pending']}")
+    for worker_id, st in status['workers'].items():
+        print(f"  {worker_id}: {st['processed']} images, {st['failed']} failed, "
+              f"{st['images_per_min']:.1f} img/min, last update {time.ctime(st['updated'])}")
+
+
+def cmd_serve(args):
+    model_paths = {}
+    for spec in args.model:
+        name, sep, path = spec.partition('=')
+        if not sep:
+            name, path = os.path.splitext(os.path.basename(spec))[0], spec
+        model_paths[name] = path
+    try:
+        service = server.SegmentationService(model_paths, workers=args.workers, memory_budget=args.memory,
+                                             max_batch_pixels=int(args.max_batch_mp * 1e6),
+                                             max_wait=args.max_wait_ms / 1000)
+    except wk.MemoryBudgetError as e:
+        sys.exit(str(e))
+    server.serve(service, host=args.host, port=args.port, unix_socket=args.unix)
+
+
+def cmd_evaluate(args):
+    try:
+        report = evaluate.evaluate_folder(args.model, args.images, args.ground_truth, n_workers=args.jobs,
+                                          memory_budget=args.memory)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    print(f"\n{report['images']} images, {len(report['failed'])} failed")
+    print(f"pixel accuracy: {report['pixel_accuracy']:.4f}, mean IoU: {report['mean_iou']:.4f}")
+    for c, iou in report['iou'].items():
+        print(f'  class {c}: IoU {iou:.4f}')
+    print('confusion matrix (rows: ground truth, columns: prediction):')
+    for row in report['confusion']:
+        print('  ' + ' '.join(f'{v:>10d}' for v in row))
+    print(f"throughput: {report['megapixels_per_s']:.2f} MP/s ({report['elapsed']:.1f} s)")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+def cmd_autotune(args):
+    img, labels = load_inputs(args)
+    try:
+        results, front = wk.autotune(img, labels, classifier=args.classifier, n_folds=args.folds,
+                                     block_size=args.block_size, n_jobs=args.jobs, budget=args.memory)
+    except (ValueError, wk.MemoryBudgetError) as e:
+        sys.exit(str(e))
+
+    print(f'{len(results)} settings tested, Pareto-optimal ones (fastest first):')
+    print(f"{'accuracy':>10}{'s/MP':>10}  settings")
+    for r in front:
+        settings = ', '.join(f'{k}={v}' for k, v in {**r['feature_params'], **r['clf_params']}.items())
+        print(f"{r['accuracy']:>10.3f}{r['seconds_per_mp']:>10.3g}  {settings}")
+
+
+def memory_gb(value):
+    return int(float(value) * 1e9)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='forestpictaker',
+                                     description='Random forest image segmentation')
+    parser.add_argument('--memory', type=memory_gb, default=None,
+                        help='RAM budget in GB (default: half of the physical memory)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('benchmark', help='compare the classifiers on a labelled image')
+    p.add_argument('image')
+    p.add_argument('labels', help='label mask (0 = unlabelled)')
+    p.add_argument('--classifiers', nargs='+', choices=list(wk.CLASSIFIERS), default=None)
+    p.add_argument('--banks', nargs='+', choices=list(wk.FEATURE_BANKS), default=[],
+                   help='colour features added to the multiscale features')
+    p.set_defaults(func=cmd_benchmark)
+
+    p = subparsers.add_parser('segment', help='train on a labelled image and segment it')
+    p.add_argument('image')
+    p.add_argument('labels', help='label mask (0 = unlabelled)')
+    p.add_argument('--classifier', choices=list(wk.CLASSIFIERS), default=wk.DEFAULT_CLASSIFIER)
+    p.add_argument('-o', '--output', default='segmented.png')
+    p.add_argument('--banks', nargs='+', choices=list(wk.FEATURE_BANKS), default=[],
+                   help='colour features added to the multiscale features')
+    p.add_argument('--export-model', default=None, help='save the trained model (.joblib)')
+    p.set_defaults(func=cmd_segment)
+
+    p = subparsers.add_parser('watch', help='segment the new images of a folder as they arrive')
+    p.add_argument('model', help='model exported from the GUI or with segment --export-model')
+    p.add_argument('folder')
+    p.add_argument('-o', '--output', default=None, help='default: FOLDER/ForestPicTaker_outputs')
+    p.add_argument('--interval', type=float, default=1.0, help='polling interval [s]')
+    p.add_argument('--stable-checks', type=int, default=2,
+                   help='number of polls without size change before an image is processed')
+    p.add_argument('--queue-size', type=int, default=2, help='images waiting in front of each stage')
+    p.add_argument('--report', type=float, default=10.0, help='statistics interval [s]')
+    p.add_argument('--output-mode', choices=list(wk.OUTPUTS), default='labels',
+                   help='labels: colour image; proba: uint8 probability of each class; top1: label and confidence')
+    p.set_defaults(func=cmd_watch)
+
+    p = subparsers.add_parser('worker', help='process a batch shared between several workers (shared folder)')
+    p.add_argument('model', help='model exported from the GUI or with segment --export-model')
+    p.add_argument('folder', help='folder of images, shared between the workers')
+    p.add_argument('-o', '--output', default=None, help='default: FOLDER/ForestPicTaker_outputs')
+    p.add_argument('--queue', default=None, help='queue folder, default: FOLDER/ForestPicTaker_queue')
+    p.add_argument('--worker-id', default=None, help='default: hostname-pid')
+    p.add_argument('--lease-ttl', type=float, default=60., help='seconds before a lease without heartbeat is reclaimed')
+    p.add_argument('--interval', type=float, default=10., help='polling interval when no image is available [s]')
+    p.add_argument('--follow', action='store_true', help='keep waiting for new images')
+    p.add_argument('--output-mode', choices=list(wk.OUTPUTS), default='labels',
+                   help='labels: colour image; proba: uint8 probability of each class; top1: label and confidence')
+    p.set_defaults(func=cmd_worker)
+
+    p = subparsers.add_parser('queue-status', help='progress of a batch processed by workers')
+    p.add_argument('folder')
+    p.add_argument('--queue', default=None)
+    p.add_argument('--lease-ttl', type=float, default=60.)
+    p.set_defaults(func=cmd_queue_status)
+
+    p = subparsers.add_parser('serve', help='local segmentation service keeping the models in memory')
+    p.add_argument('--model', action='append', required=True,
+                   help='NAME=PATH of a model exported from the GUI or with segment --export-model (repeatable)')
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8765)
+    p.add_argument('--unix', default=None, help='listen on a unix socket instead of host/port')
+    p.add_argument('--workers', type=int, default=None, help='images processed at the same time')
+    p.add_argument('--max-batch-mp', type=float, default=4., help='maximum batch size [megapixels]')
+    p.add_argument('--max-wait-ms', type=float, default=20., help='maximum wait for a batch to fill [ms]')
+    p.set_defaults(func=cmd_serve)
+
+    p = subparsers.add_parser('evaluate', help='compare the segmentation of a model with ground-truth masks')
+    p.add_argument('model', help='model exported from the GUI or with segment --export-model')
+    p.add_argument('images', help='folder of images')
+    p.add_argument('ground_truth', help='folder of label masks with the same names (0 = not annotated)')
+    p.add_argument('--jobs', type=int, default=None, help='number of worker processes')
+    p.add_argument('--json', default=None, help='save the report to a JSON file')
+    p.set_defaults(func=cmd_evaluate)
+
+    p = subparsers.add_parser('autotune', help='search the Pareto-optimal settings (accuracy vs speed)')
+    p.add_argument('image')
+    p.add_argument('labels', help='label mask (0 = unlabelled)')
+    p.add_argument('--classifier', choices=['RandomForest', 'ExtraTrees'], default=wk.DEFAULT_CLASSIFIER)
+    p.add_argument('--folds', type=int, default=3)
+    p.add_argument('--block-size', type=int, default=64, help='size of the cross-validation blocks [px]')
+    p.add_argument('--jobs', type=int, default=None)
+    p.set_defaults(func=cmd_autotune)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.func(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+"""
+Evaluation of a saved model against ground-truth label masks.
+
+Images are segmented in parallel worker processes. Each worker only returns a confusion
+matrix and timings, which are summed as results arrive, so that the memory used does not
+depend on the number of images.
+"""
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from skimage import io
+
+import weka as wk
+import stream
+
+_model = None
+
+
+class ConfusionAccumulator:
+    """
+    Confusion matrix summed over images (rows: ground truth, columns: prediction).
+    Label 0 of the ground truth means 'not annotated' and is ignored.
+    """
+    def __init__(self, n_labels):
+        """
+        :param n_labels: number of labels, including 0
+        """
+        self.n_labels = n_labels
+        self.matrix = np.zeros((n_labels, n_labels), dtype=np.int64)
+
+    def update(self, ground_truth, prediction):
+        mask = (ground_truth > 0) & (ground_truth < self.n_labels)
+        idx = ground_truth[mask].astype(np.int64) * self.n_labels + prediction[mask].astype(np.int64)
+        self.matrix += np.bincount(idx, minlength=self.n_labels ** 2).reshape(self.n_labels, self.n_labels)
+
+    def add(self, matrix):
+        self.matrix += matrix
+
+    def pixel_accuracy(self):
+        total = self.matrix[1:].sum()
+        return np.trace(self.matrix[1:, 1:]) / total if total else float('nan')
+
+    def iou(self):
+        """
+        Intersection over union of each class (labels 1..n)
+        """
+        m = self.matrix[1:, 1:]
+        tp = np.diag(m)
+        union = self.matrix[1:].sum(axis=1) + m.sum(axis=0) - tp
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return tp / union
+
+
+def find_ground_truth(gt_folder, image_path):
+    """
+    Ground-truth mask with the same name as the image (any image extension)
+    """
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    for ext in ('.png', '.tif', '.tiff', '.bmp'):
+        path = os.path.join(gt_folder, stem + ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _init_worker(model_path):
+    global _model
+    clf, features_func = wk.load_model(model_path)
+    # parallelism is done across images
+    if 'n_jobs' in clf.get_params():
+        clf.set_params(n_jobs=1)
+    _model = clf, features_func
+
+
+def _evaluate_image(args):
+    image_path, gt_path, n_labels, memory_budget = args
+    clf, features_func = _model
+
+    t0 = time.perf_counter()
+    img = wk.rgba2rgb(io.imread(image_path))
+    ground_truth = io.imread(gt_path)
+    if ground_truth.ndim == 3:
+        ground_truth = ground_truth[..., 0]
+    if ground_truth.shape != img.shape[:2]:
+        raise ValueError(f'{gt_path}: shape {ground_truth.shape} does not match image {img.shape[:2]}')
+    t1 = time.perf_counter()
+    prediction = wk.predict_image_budget(img, clf, features_func, memory_budget)
+    t2 = time.perf_counter()
+
+    acc = ConfusionAccumulator(n_labels)
+    acc.update(ground_truth, prediction)
+    return acc.matrix, img.shape[0] * img.shape[1], t1 - t0, t2 - t1
+
+
+def evaluate_folder(model_path, image_folder, gt_folder, n_workers=None, memory_budget=None):
+    """
+    Segment all the images of a folder that have a ground truth, and compare the results
+    :param model_path: model saved with export_model
+    :param memory_budget: total RAM budget in bytes, shared between the workers
+    :return: dict with the confusion matrix, per-class IoU, pixel accuracy and throughput
+    """
+    clf, _ = wk.load_model(model_path)
+    n_labels = int(np.max(clf.classes_)) + 1
+
+    pairs = []
+    for path in stream.list_images(image_folder):
+        gt_path = find_ground_truth(gt_folder, path)
+        if gt_path is None:
+            print(f'{path}: no ground truth, skipped')
+        else:
+            pairs.append((path, gt_path))
+    if not pairs:
+        raise ValueError(f'No image of {image_folder} has a ground truth in {gt_folder}')
+
+    n_workers = n_workers or os.cpu_count()
+    budget = (memory_budget or wk.default_memory_budget()) // n_workers
+
+    acc = ConfusionAccumulator(n_labels)
+    n_pixels, read_time, predict_time, failed = 0, 0., 0., []
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(model_path,)) as executor:
+        futures = [executor.submit(_evaluate_image, (path, gt_path, n_labels, budget)) for path, gt_path in pairs]
+        for (path, _), fut in zip(pairs, futures):
+            try:
+                matrix, pixels, t_read, t_predict = fut.result()
+            except Exception as e:
+                print(f'{path} failed: {e}')
+                failed.append(path)
+                continue
+            acc.add(matrix)
+            n_pixels += pixels
+            read_time += t_read
+            predict_time += t_predict
+            print(f'{path} evaluated')
+    elapsed = time.perf_counter() - t0
+
+    return {'images': len(pairs) - len(failed),
+            'failed': failed,
+            'classes': [int(c) for c in clf.classes_],
+            'confusion': acc.matrix[1:, 1:].tolist(),
+            'iou': {int(c): float(acc.iou()[c - 1]) for c in clf.classes_},
+            'mean_iou': float(np.nanmean(acc.iou()[clf.classes_ - 1])),
+            'pixel_accuracy': float(acc.pixel_accuracy()),
+            'elapsed': elapsed,
+            'megapixels_per_s': n_pixels / 1e6 / elapsed,
+            'read_time': read_time,
+            'predict_time': predict_time}
@@ -0,0 +1,301 @@
+"""
+Distribution of a batch of images between several processes or machines sharing a folder (e.g. NFS).
+
+No server is needed: the state of the batch is kept as small files in a queue folder.
+- leases/<image>.lease: created atomically (O_EXCL) by the worker that processes the image. The worker
+  refreshes its modification time (heartbeat); a lease that was not refreshed for `lease_ttl` seconds
+  is considered abandoned and can be reclaimed by another worker. To reclaim it, the worker renames it
+  to a name of its own and checks that it moved the lease it found stale (same token and modification
+  time); otherwise the lease was renewed or reclaimed in the meantime and is given back.
+- done/<image>.done: written once the output is saved (or the image failed).
+- stats/<worker>.json: statistics of each worker.
+"""
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+import zlib
+
+from skimage import io
+
+import weka as wk
+import stream
+
+
+def _write_atomic(path, text):
+    # write then rename, so that readers never see a partial file
+    tmp = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+class JobQueue:
+    """
+    Shared-folder queue of the images of a batch
+    """
+    def __init__(self, image_folder, queue_folder=None, lease_ttl=60.):
+        self.image_folder = image_folder
+        self.queue_folder = queue_folder or os.path.join(image_folder, 'ForestPicTaker_queue')
+        self.lease_ttl = lease_ttl
+        for sub in ('leases', 'done', 'stats'):
+            os.makedirs(os.path.join(self.queue_folder, sub), exist_ok=True)
+
+    def key(self, path):
+        return os.path.basename(path)
+
+    def lease_path(self, path):
+        return os.path.join(self.queue_folder, 'leases', self.key(path) + '.lease')
+
+    def done_path(self, path):
+        return os.path.join(self.queue_folder, 'done', self.key(path) + '.done')
+
+    def images(self):
+        return stream.list_images(self.image_folder)
+
+    def server_time(self):
+        """
+        Current time of the file server, to compare with lease modification times
+        (the clocks of the machines may differ)
+        """
+        probe = os.path.join(self.queue_folder, f'.clock.{uuid.uuid4().hex}')
+        with open(probe, 'w'):
+            pass
+        now = os.stat(probe).st_mtime
+        os.remove(probe)
+        return now
+
+    def is_done(self, path):
+        return os.path.exists(self.done_path(path))
+
+    def try_claim(self, path, token, now):
+        """
+        Atomically take the lease of an image
+        :param token: unique id of the claim, written in the lease
+        :param now: server time
+        :return: True if the lease was obtained
+        """
+        lease = self.lease_path(path)
+        try:
+            fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                seen = os.stat(lease)
+                with open(lease) as f:
+                    seen_token = f.read()
+            except FileNotFoundError:
+                # released in the meantime, it will be retried at the next pass
+                return False
+            age = now - seen.st_mtime
+            if age < self.lease_ttl:
+                return False
+            # abandoned lease: move it aside, then check that the file moved is the one seen as stale
+            stale = f'{lease}.{token}.stale'
+            try:
+                os.rename(lease, stale)
+            except FileNotFoundError:
+                return False
+            moved = os.stat(stale)
+            with open(stale) as f:
+                moved_token = f.read()
+            if moved_token != seen_token or moved.st_mtime != seen.st_mtime:
+                # renewed or reclaimed by another worker since it was seen: give it back
+                # (link does not replace a lease created in the meantime)
+                try:
+                    os.link(stale, lease)
+                except FileExistsError:
+                    pass
+                os.remove(stale)
+                return False
+            os.remove(stale)
+            print(f'{self.key(path)}: stale lease ({age:.0f} s) reclaimed')
+            return self.try_claim(path, token, now)
+
+        with os.fdopen(fd, 'w') as f:
+            f.write(token)
+        return True
+
+    def owns(self, path, token):
+        try:
+            with open(self.lease_path(path)) as f:
+                return f.read() == token
+        except FileNotFoundError:
+            return False
+
+    def heartbeat(self, path):
+        try:
+            os.utime(self.lease_path(path))
+        except FileNotFoundError:
+            pass
+
+    def release(self, path, token):
+        if self.owns(path, token):
+            os.remove(self.lease_path(path))
+
+    def mark_done(self, path, worker_id, error=None):
+        """
+        Images that failed are marked too, so that they are not retried forever
+        """
+        _write_atomic(self.done_path(path), json.dumps({'worker': worker_id, 'time': time.time(), 'error': error}))
+
+    def status(self):
+        """
+        :return: dict with the number of done, leased and pending images, and the worker statistics
+        """
+        now = self.server_time()
+        counts = {'done': 0, 'leased': 0, 'stale': 0, 'pending': 0}
+        for path in self.images():
+            if self.is_done(path):
+                counts['done'] += 1
+                continue
+            try:
+                age = now - os.stat(self.lease_path(path)).st_mtime
+                counts['leased' if age < self.lease_ttl else 'stale'] += 1
+            except FileNotFoundError:
+                counts['pending'] += 1
+
+        workers = {}
+        stats_folder = os.path.join(self.queue_folder, 'stats')
+        for name in os.listdir(stats_folder):
+            if name.endswith('.json'):
+                with open(os.path.join(stats_folder, name)) as f:
+                    workers[name[:-5]] = json.load(f)
+        counts['workers'] = workers
+        return counts
+
+
+class Worker:
+    """
+    Process the images of a JobQueue until none is left
+    """
+    def __init__(self, job_queue, clf, features_func, out_folder, worker_id=None, memory_budget=None,
+                 output='labels', settle_time=5.):
+        """
+        :param settle_time: images modified less than this time ago [s] may still be copied, they are not claimed
+        """
+        self.queue = job_queue
+        self.settle_time = settle_time
+        self.failed_files = {}  # path -> (mtime, size) of the file when it failed (follow mode)
+        self.output = output
+        self.clf = clf
+        self.features_func = features_func
+        self.out_folder = out_folder
+        self.worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}'
+        self.memory_budget = memory_budget
+        self.current = None
+        self.stop_event = threading.Event()
+        self.stats = {'processed': 0, 'failed': 0, 'lost_leases': 0, 'megapixels': 0., 'busy_time': 0.,
+                      'start': time.time()}
+        os.makedirs(out_folder, exist_ok=True)
+
+    def _heartbeat_loop(self):
+        while not self.stop_event.wait(self.queue.lease_ttl / 3):
+            current = self.current
+            if current is not None:
+                self.queue.heartbeat(current)
+
+    def claim_next(self):
+        """
+        :return: (image path, token) or (None, None) if no image is available
+        """
+        now = self.queue.server_time()
+        images = [p for p in self.queue.images() if not self.queue.is_done(p) and self._ready(p, now)]
+        if not images:
+            return None, None
+        # each worker starts at a different position, to limit contention on the same leases
+        start = zlib.crc32(self.worker_id.encode()) % len(images)
+        for path in images[start:] + images[:start]:
+            token = f'{self.worker_id}:{uuid.uuid4().hex}'
+            if self.queue.try_claim(path, token, now):
+                if self.queue.is_done(path):
+                    # finished by another worker since the listing
+                    self.queue.release(path, token)
+                    continue
+                return path, token
+        return None, None
+
+    def _ready(self, path, now):
+        """
+        False for the images still being copied, and for those that failed and did not change since
+        """
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return False
+        if now - st.st_mtime < self.settle_time:
+            return False
+        return self.failed_files.get(path) != (st.st_mtime, st.st_size)
+
+    def process(self, path, token):
+        t0 = time.perf_counter()
+        img = wk.rgba2rgb(io.imread(path))
+        result = wk.predict_image_budget(img, self.clf, self.features_func, self.memory_budget, self.output)
+
+        if not self.queue.owns(path, token):
+            # the lease expired and another worker took the image
+            self.stats['lost_leases'] += 1
+            print(f'{path}: lease lost, result dropped')
+            return
+
+        dest_path = stream.output_path(self.out_folder, path, self.output)
+        root, ext = os.path.splitext(dest_path)
+        tmp = f'{root}.{uuid.uuid4().hex}.tmp{ext}'
+        stream.save_output(result, tmp, self.output, self.clf.classes_)
+        os.replace(tmp, dest_path)
+        self.queue.mark_done(path, self.worker_id)
+
+        self.stats['processed'] += 1
+        self.stats['megapixels'] += img.shape[0] * img.shape[1] / 1e6
+        self.stats['busy_time'] += time.perf_counter() - t0
+        print(f'{path} segmented')
+
+    def write_stats(self):
+        stats = dict(self.stats, updated=time.time())
+        elapsed = stats['updated'] - stats['start']
+        stats['images_per_min'] = 60 * stats['processed'] / elapsed if elapsed else 0.
+        path = os.path.join(self.queue.queue_folder, 'stats', f'{self.worker_id}.json')
+        _write_atomic(path, json.dumps(stats, indent=2))
+
+    def run(self, follow=False, poll_interval=10.):
+        """
+        :param follow: keep waiting for new images once the batch is finished
+        """
+        heartbeat = threading.Thread(target=self._heartbeat_loop, daemon=True)
+        heartbeat.start()
+        try:
+            while not self.stop_event.is_set():
+                path, token = self.claim_next()
+                if path is None:
+                    pending = [p for p in self.queue.images() if not self.queue.is_done(p)]
+                    if not pending and not follow:
+                        break
+                    # images leased by other workers: wait, their leases may become stale
+                    self.write_stats()
+                    self.stop_event.wait(poll_interval)
+                    continue
+
+                self.current = path
+                try:
+                    self.process(path, token)
+                except Exception as e:
+                    self.stats['failed'] += 1
+                    if follow:
+                        # maybe an incomplete copy: retried if the file changes
+                        print(f'{path} failed, retried when the file changes: {e}')
+                        try:
+                            st = os.stat(path)
+                            self.failed_files[path] = (st.st_mtime, st.st_size)
+                        except FileNotFoundError:
+                            pass
+                    else:
+                        print(f'{path} failed: {e}')
+                        self.queue.mark_done(path, self.worker_id, error=str(e))
+                finally:
+                    self.current = None
+                    self.queue.release(path, token)
+                self.write_stats()
+        finally:
+            self.stop_event.set()
+            self.write_stats()
@@ -4,11 +4,15 @@ from skimage import color, io, data, segmentation, feature, future
 import matplotlib
 import matplotlib.pyplot as plt
 matplotlib.use('qtagg') # for avoiding problems with pyinstaller
+import ast
+import copy
 import os
 
 # custom libraries
 import widgets as wid
 import weka as wk
+import stream
+import project as prj
 import resources as res
 
 
@@ -19,10 +23,8 @@ class PixelCategory:
     def __init__(self):
         self.nb_roi_rect = 0
         self.nb_roi_brush = 0
-        self.item_list_rect = []
-        self.item_list_brush = []
         self.roi_list_rect = []
-        self.roi_list_brush = []
+        self.roi_list_brush = []  # bounding box (top, left, bottom, right) of each stroke
         self.color = None
         self.name = ''
 
@@ -56,6 +58,236 @@ class AboutDialog(QtWidgets.QDialog):
 
         self.setLayout(self.layout)
 
+class ParametersDialog(QtWidgets.QDialog):
+    """
+    Dialog to choose the segmentation parameters
+    """
+    def __init__(self, classifier, feature_params, clf_params, memory_budget, batch_output, refit_fraction,
+                 benchmark_func=None, autotune_func=None):
+        super().__init__()
+
+        self.setWindowTitle('Segmentation parameters')
+        self.benchmark_func = benchmark_func
+        self.autotune_func = autotune_func
+        self.clf_params = dict(clf_params)
+        self.clf_edits = {}
+        self.layout = QtWidgets.QVBoxLayout()
+
+        # features
+        group_feat = QtWidgets.QGroupBox('Features')
+        form_feat = QtWidgets.QFormLayout()
+        self.spinBox_sigma_min = QtWidgets.QDoubleSpinBox()
+        self.spinBox_sigma_max = QtWidgets.QDoubleSpinBox()
+        for spin in (self.spinBox_sigma_min, self.spinBox_sigma_max):
+            spin.setRange(0.1, 128)
+            spin.setSingleStep(0.5)
+        # at least one scale: sigma max cannot go below sigma min
+        self.spinBox_sigma_min.valueChanged.connect(self.spinBox_sigma_max.setMinimum)
+        self.checkBox_edges = QtWidgets.QCheckBox()
+        self.checkBox_texture = QtWidgets.QCheckBox()
+        form_feat.addRow('Sigma min', self.spinBox_sigma_min)
+        form_feat.addRow('Sigma max', self.spinBox_sigma_max)
+        form_feat.addRow('Edges', self.checkBox_edges)
+        form_feat.addRow('Texture', self.checkBox_texture)
+        # colour features (vegetation indices, colour spaces)
+        self.checkBox_banks = {}
+        for name in wk.FEATURE_BANKS:
+            self.checkBox_banks[name] = QtWidgets.QCheckBox()
+            form_feat.addRow(name.upper(), self.checkBox_banks[name])
+        group_feat.setLayout(form_feat)
+        self.layout.addWidget(group_feat)
+        self.set_feature_params(feature_params)
+
+        # memory
+        group_mem = QtWidgets.QGroupBox('Memory')
+        form_mem = QtWidgets.QFormLayout()
+        self.spinBox_budget = QtWidgets.QDoubleSpinBox()
+        self.spinBox_budget.setRange(0.5, 1024)
+        self.spinBox_budget.setSingleStep(0.5)
+        self.spinBox_budget.setValue(memory_budget / 1e9)
+        self.spinBox_budget.setToolTip('Large images are processed by tiles to stay below this budget')
+        form_mem.addRow('RAM budget [GB]', self.spinBox_budget)
+        group_mem.setLayout(form_mem)
+        self.layout.addWidget(group_mem)
+
+        # outputs of 'apply to folder' and 'watch folder'
+        group_out = QtWidgets.QGroupBox('Batch outputs')
+        form_out = QtWidgets.QFormLayout()
+        self.comboBox_output = QtWidgets.QComboBox()
+        for key, desc in wk.OUTPUTS.items():
+            self.comboBox_output.addItem(desc, key)
+        self.comboBox_output.setCurrentIndex(list(wk.OUTPUTS).index(batch_output))
+        self.comboBox_output.setToolTip('Probabilities are saved as compressed multi-band TIFF')
+        form_out.addRow('Output', self.comboBox_output)
+        group_out.setLayout(form_out)
+        self.layout.addWidget(group_out)
+
+        # classifier
+        group_clf = QtWidgets.QGroupBox('Classifier')
+        self.form_clf = QtWidgets.QFormLayout()
+        self.comboBox_clf = QtWidgets.QComboBox()
+        self.comboBox_clf.addItems(list(wk.CLASSIFIERS))
+        self.comboBox_clf.setCurrentText(classifier)
+        self.form_clf.addRow('Classifier', self.comboBox_clf)
+        group_clf.setLayout(self.form_clf)
+        self.layout.addWidget(group_clf)
+        self.update_clf_fields()
+        self.comboBox_clf.currentIndexChanged.connect(self.on_clf_change)
+
+        # retraining of forests after new ROIs
+        group_refit = QtWidgets.QGroupBox('Retraining')
+        form_refit = QtWidgets.QFormLayout()
+        self.spinBox_refit = QtWidgets.QSpinBox()
+        self.spinBox_refit.setRange(10, 100)
+        self.spinBox_refit.setSingleStep(10)
+        self.spinBox_refit.setValue(int(round(refit_fraction * 100)))
+        self.spinBox_refit.setToolTip('Below 100 %, a forest is retrained by regrowing only this part of its trees: '
+                                      'faster, but the new ROIs only weigh in the votes of the new trees')
+        form_refit.addRow('Trees regrown [%]', self.spinBox_refit)
+        group_refit.setLayout(form_refit)
+        self.layout.addWidget(group_refit)
+
+        # benchmark of all classifiers on the current labels
+        self.pushButton_bench = QtWidgets.QPushButton('Benchmark on current labels')
+        self.pushButton_bench.setEnabled(benchmark_func is not None)
+        self.pushButton_bench.clicked.connect(self.run_benchmark)
+        self.layout.addWidget(self.pushButton_bench)
+
+        self.bench_columns = ['name', 'accuracy', 'fit_time', 'pixels_per_s', 'fit_memory_mb', 'model_size_mb']
+        self.table = QtWidgets.QTableWidget(0, len(self.bench_columns))
+        self.table.setHorizontalHeaderLabels(['Classifier', 'Accuracy', 'Fit [s]', 'Pixels/s',
+                                              'Fit memory [MB]', 'Model [MB]'])
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.layout.addWidget(self.table)
+
+        # automatic tuning: Pareto-optimal settings (speed vs accuracy)
+        self.pushButton_tune = QtWidgets.QPushButton('Auto-tune on current labels')
+        self.pushButton_tune.setEnabled(autotune_func is not None)
+        self.pushButton_tune.clicked.connect(self.run_autotune)
+        self.layout.addWidget(self.pushButton_tune)
+
+        self.tune_results = []
+        self.table_tune = QtWidgets.QTableWidget(0, 3)
+        self.table_tune.setHorizontalHeaderLabels(['Accuracy', 's / megapixel', 'Settings'])
+        self.table_tune.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.table_tune.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectRows)
+        self.table_tune.cellClicked.connect(self.on_tune_selected)
+        self.layout.addWidget(self.table_tune)
+
+        buttons = QtWidgets.QDialogButtonBox(QtWidgets.QDialogButtonBox.Ok | QtWidgets.QDialogButtonBox.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        self.layout.addWidget(buttons)
+
+        self.setLayout(self.layout)
+
+    def set_feature_params(self, params):
+        self.spinBox_sigma_min.setValue(params['sigma_min'])
+        self.spinBox_sigma_max.setValue(params['sigma_max'])
+        self.checkBox_edges.setChecked(params['edges'])
+        self.checkBox_texture.setChecked(params['texture'])
+        for name, checkBox in self.checkBox_banks.items():
+            checkBox.setChecked(name in params.get('banks', ()))
+
+    def on_clf_change(self):
+        self.clf_params = {}
+        self.update_clf_fields()
+
+    def update_clf_fields(self):
+        """
+        One text field per parameter of the selected classifier
+        """
+        while self.form_clf.rowCount() > 1:
+            self.form_clf.removeRow(1)
+        self.clf_edits = {}
+
+        _, defaults = wk.CLASSIFIERS[self.get_classifier()]
+        for key, value in defaults.items():
+            edit = QtWidgets.QLineEdit(repr(self.clf_params.get(key, value)))
+            self.form_clf.addRow(key, edit)
+            self.clf_edits[key] = edit
+
+    def run_benchmark(self):
+        QtWidgets.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
+        try:
+            reports = self.benchmark_func()
+        except (ValueError, MemoryError) as e:
+            QtWidgets.QMessageBox.warning(self, 'Benchmark', str(e))
+            return
+        finally:
+            QtWidgets.QApplication.restoreOverrideCursor()
+
+        self.table.setRowCount(len(reports))
+        for i, report in enumerate(reports):
+            for j, key in enumerate(self.bench_columns):
+                value = report[key]
+                text = value if isinstance(value, str) else f'{value:.3g}'
+                self.table.setItem(i, j, QtWidgets.QTableWidgetItem(text))
+        self.table.resizeColumnsToContents()
+
+    def run_autotune(self):
+        QtWidgets.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
+        try:
+            _, self.tune_results = self.autotune_func(self.get_classifier())
+        except (ValueError, MemoryError) as e:
+            QtWidgets.QMessageBox.warning(self, 'Auto-tune', str(e))
+            return
+        finally:
+            QtWidgets.QApplication.restoreOverrideCursor()
+
+        self.table_tune.setRowCount(len(self.tune_results))
+        for i, r in enumerate(self.tune_results):
+            settings = ', '.join(f'{k}={v}' for k, v in {**r['feature_params'], **r['clf_params']}.items())
+            self.table_tune.setItem(i, 0, QtWidgets.QTableWidgetItem(f"{r['accuracy']:.3f}"))
+            self.table_tune.setItem(i, 1, QtWidgets.QTableWidgetItem(f"{r['seconds_per_mp']:.3g}"))
+            self.table_tune.setItem(i, 2, QtWidgets.QTableWidgetItem(settings))
+        self.table_tune.resizeColumnsToContents()
+
+    def on_tune_selected(self, row, column):
+        """
+        Apply the settings of the selected Pareto-optimal result
+        """
+        r = self.tune_results[row]
+        self.set_feature_params(r['feature_params'])
+        self.clf_params.update(r['clf_params'])
+        self.update_clf_fields()
+
+    def get_classifier(self):
+        return self.comboBox_clf.currentText()
+
+    def get_memory_budget(self):
+        return int(self.spinBox_budget.value() * 1e9)
+
+    def get_batch_output(self):
+        return self.comboBox_output.currentData()
+
+    def get_refit_fraction(self):
+        return self.spinBox_refit.value() / 100
+
+    def get_feature_params(self):
+        return dict(sigma_min=self.spinBox_sigma_min.value(),
+                    sigma_max=self.spinBox_sigma_max.value(),
+                    edges=self.checkBox_edges.isChecked(),
+                    texture=self.checkBox_texture.isChecked(),
+                    banks=tuple(name for name, checkBox in self.checkBox_banks.items() if checkBox.isChecked()))
+
+    def get_clf_params(self):
+        """
+        Parameters that differ from the classifier defaults
+        """
+        _, defaults = wk.CLASSIFIERS[self.get_classifier()]
+        params = {}
+        for key, edit in self.clf_edits.items():
+            try:
+                value = ast.literal_eval(edit.text())
+            except (ValueError, SyntaxError):
+                print(f'invalid value for {key}: {edit.text()}, default is kept')
+                continue
+            if value != defaults[key]:
+                params[key] = value
+        return params
+
+
 class WEKAWindow(QtWidgets.QMainWindow):
     """
     Main Window class for the ForestPicTaker application.
@@ -84,6 +316,24 @@ class WEKAWindow(QtWidgets.QMainWindow):
         self.active_category = None
         self.training_labels = None
         self.model_available = False
+        self.features = None
+        self.uncertainty = wk.UncertaintyMap()
+        self.classifier_name = wk.DEFAULT_CLASSIFIER
+        self.clf_name = None
+        self.model_classifier = None  # classifier of the trained model (clf_name is cleared when settings change)
+        self.clf_params = {}
+        self.feature_params = dict(wk.DEFAULT_FEATURE_PARAMS)
+        self.memory_budget = wk.default_memory_budget()
+        self.batch_output = 'labels'
+        self.refit_fraction = 1.  # part of the trees regrown when retraining a forest (1 = full retrain)
+        self.streamer = None
+        self.watch_timer = QtCore.QTimer(self)
+
+        # reopened project: labels and model are loaded on first use
+        self.project = None
+        self.restore_labels = False
+        self._clf = None
+        self._base_labels = None
 
         # Create model (for the tree structure)
         self.model = QtGui.QStandardItemModel()
@@ -105,9 +355,11 @@ class WEKAWindow(QtWidgets.QMainWindow):
         self.add_icon(res.find('img/brush.png'), self.actionBrush)
         self.add_icon(res.find('img/test.png'), self.actionTest)
         self.add_icon(res.find('img/forest.png'), self.actionRun)
+        self.add_icon(res.find('img/magic2.png'), self.actionUncertainty)
         self.add_icon(res.find('img/reset.png'), self.actionReset_all)
         self.add_icon(res.find('img/settings.png'), self.actionParameters)
         self.add_icon(res.find('img/folder.png'), self.actionApply_to_folder)
+        self.add_icon(res.find('img/folder.png'), self.actionWatch_folder)
         self.add_icon(res.find('img/info.png'), self.actionInfo)
 
         self.viewer = wid.PhotoViewer(self)
@@ -128,6 +380,16 @@ class WEKAWindow(QtWidgets.QMainWindow):
         self.categories = []
         self.active_category = None
         self.training_labels = None
+        self.model_available = False
+        self.model_classifier = None
+        self.features = None
+        self.project = None
+        self.restore_labels = False
+        self._clf = None
+        self._base_labels = None
+        self.uncertainty.reset()
+        self.actionUncertainty.setChecked(False)
+        self.actionUncertainty.setEnabled(False)
 
         # Create model (for the tree structure)
         self.model = QtGui.QStandardItemModel()
@@ -148,17 +410,40 @@ class WEKAWindow(QtWidgets.QMainWindow):
         for cat in self.categories:
             cat.nb_roi_rect = 0
             cat.nb_roi_brush = 0
-            cat.item_list_rect = []
-            cat.item_list_brush = []
             cat.roi_list_rect = []
             cat.roi_list_brush = []
 
             self.add_item_in_tree(self.model, cat.name)
             self.model.setHeaderData(0, QtCore.Qt.Horizontal, 'Categories')
 
+        # labels of a reopened project are removed too
+        self.restore_labels = False
+        self._base_labels = None
+        self.viewer.set_labels(None)
+
         # clean graphicscene
         self.viewer.clean_scene()
 
+    @property
+    def clf(self):
+        if self._clf is None and self.project is not None:
+            # model of a reopened project, loaded on first use
+            self._clf = self.project.model
+        return self._clf
+
+    @clf.setter
+    def clf(self, value):
+        self._clf = value
+
+    @property
+    def base_labels(self):
+        """
+        Label mask of a reopened project (None if there is none)
+        """
+        if self._base_labels is None and self.project is not None and self.restore_labels:
+            self._base_labels = self.project.labels
+        return self._base_labels
+
     def add_icon(self, img_source, pushButton_object):
         """
         Function to add an icon to a pushButton
@@ -174,9 +459,16 @@ class WEKAWindow(QtWidgets.QMainWindow):
         self.actionRectangle_selection.triggered.connect(self.rectangle_selection)
         self.actionBrush.triggered.connect(self.brush_selection)
         self.actionRun.triggered.connect(self.go_segment)
+        self.actionUncertainty.triggered.connect(self.show_uncertainty)
         self.actionTest.triggered.connect(self.generate_multi_outputs)
+        self.actionParameters.triggered.connect(self.show_parameters)
         self.actionReset_all.triggered.connect(self.reset_roi)
         self.actionApply_to_folder.triggered.connect(self.apply_to_folder)
+        self.actionWatch_folder.triggered.connect(self.watch_folder)
+        self.actionExport_model.triggered.connect(self.export_model)
+        self.actionSave_project.triggered.connect(self.save_project)
+        self.actionOpen_project.triggered.connect(self.open_project)
+        self.watch_timer.timeout.connect(self.update_watch_status)
         self.actionInfo.triggered.connect(self.show_info)
 
         self.viewer.endDrawing_rect.connect(self.add_roi_rect)
@@ -188,6 +480,73 @@ class WEKAWindow(QtWidgets.QMainWindow):
         if dialog.exec_():
             pass
 
+    def show_parameters(self):
+        benchmark_func = None
+        autotune_func = None
+        if self.image_loaded and any(cat.nb_roi_rect or cat.nb_roi_brush for cat in self.categories):
+            benchmark_func = self.benchmark_classifiers
+            autotune_func = self.autotune
+
+        dialog = ParametersDialog(self.classifier_name, self.feature_params, self.clf_params, self.memory_budget,
+                                  self.batch_output, self.refit_fraction, benchmark_func, autotune_func)
+        if dialog.exec_():
+            self.memory_budget = dialog.get_memory_budget()
+            self.batch_output = dialog.get_batch_output()
+            self.refit_fraction = dialog.get_refit_fraction()
+            feature_params = dialog.get_feature_params()
+            if feature_params != self.feature_params:
+                # features have to be recomputed
+                self.feature_params = feature_params
+                self.features = None
+                # the current model does not match the new features until it is retrained
+                self.uncertainty.reset()
+                self.actionUncertainty.setChecked(False)
+                self.actionUncertainty.setEnabled(False)
+                self.viewer.set_uncertainty(None)
+            self.classifier_name = dialog.get_classifier()
+            self.clf_params = dialog.get_clf_params()
+            self.clf_name = None  # next run trains a new model
+
+    def compute_features(self):
+        """
+        Training labels and features of the current image (features are computed once)
+        """
+        img = wk.rgba2rgb(self.image_array)
+        self.training_labels = self.viewer.get_labels()
+        if self.features is None:
+            # self.feat_func is only replaced when a model is trained on these features
+            features_func = wk.get_features_func(**self.feature_params)
+            n_classes = max(2, len(self.categories))
+            plan = wk.plan_memory(img.shape, self.feature_params, n_classes=n_classes, budget=self.memory_budget)
+            if plan['tile_size'] is None:
+                self.features = features_func(img)
+            else:
+                # too large to keep the features in memory: they are computed by tiles when needed
+                self.statusbar.showMessage(f"Large image: processed by tiles of {plan['tile_size']} px")
+        return img
+
+    def benchmark_classifiers(self):
+        """
+        Compare all the available classifiers on the current labels
+        """
+        self.compute_features()
+        if self.features is None:
+            raise wk.MemoryBudgetError('The features of this image do not fit in the memory budget')
+        return wk.benchmark_classifiers(self.training_labels, self.features)
+
+    def autotune(self, classifier):
+        """
+        Search the Pareto-optimal settings (accuracy vs speed) on the current labels
+        """
+        img = wk.rgba2rgb(self.image_array)
+        self.training_labels = self.viewer.get_labels()
+        search_space = dict(wk.SEARCH_SPACE)
+        if classifier not in ('RandomForest', 'ExtraTrees'):
+            # only tune the features for the other engines
+            search_space = {k: v for k, v in search_space.items() if k in wk.FEATURE_KEYS}
+        return wk.autotune(img, self.training_labels, search_space, classifier=classifier,
+                           budget=self.memory_budget)
+
     def apply_to_folder(self):
         if self.model_available:
             # dialog folder selection
@@ -212,13 +571,131 @@ class WEKAWindow(QtWidgets.QMainWindow):
                 for i, path in enumerate(img_paths):
                     img_array = io.imread(path)
                     img_array = wk.rgba2rgb(img_array)
-                    self.training_labels = wk.generate_training(img_array, self.categories)
-                    features_new = self.feat_func(img_array)
-                    results_new = future.predict_segmenter(features_new, self.clf)
-                    results = color.label2rgb(results_new)
+                    try:
+                        results_new = wk.predict_image_budget(img_array, self.clf, self.feat_func,
+                                                              self.memory_budget, self.batch_output)
+                    except wk.MemoryBudgetError as e:
+                        print(f'{path} skipped: {e}')
+                        continue
+
+                    dest_path = stream.output_path(self.app_folder, path, self.batch_output)
+                    stream.save_output(results_new, dest_path, self.batch_output, self.clf.classes_)
+
+    def watch_folder(self):
+        """
+        Start or stop the segmentation of the images arriving in a folder
+        """
+        if not self.actionWatch_folder.isChecked():
+            self.watch_timer.stop()
+            if self.streamer is not None:
+                # images already in the pipeline are finished in the background
+                self.streamer.stop(wait=False)
+                self.streamer = None
+            self.statusbar.showMessage('Folder watching stopped')
+            return
+
+        folder = str(QtWidgets.QFileDialog.getExistingDirectory(self, "Select the directory to watch"))
+        if folder == "":
+            self.actionWatch_folder.setChecked(False)
+            return
+
+        out_folder = os.path.join(folder, 'ForestPicTaker_outputs')
+        # copy, so that retraining in the GUI does not modify the model used by the pipeline
+        self.streamer = stream.StreamingSegmenter(copy.deepcopy(self.clf), self.feat_func,
+                                                  out_folder, memory_budget=self.memory_budget,
+                                                  output=self.batch_output)
+        self.streamer.watch(folder)
+        self.watch_timer.start(1000)
+
+    def update_watch_status(self):
+        st = self.streamer.stats()
+        queued = ', '.join(f'{k}: {v}' for k, v in st['queued'].items())
+        self.statusbar.showMessage(f"Watching folder - {st['processed']} images segmented "
+                                   f"({st['images_per_min']:.1f} img/min, {st['megapixels_per_s']:.2f} MP/s), "
+                                   f"queued [{queued}]")
+
+    def export_model(self):
+        """
+        Save the trained model, to use it with the command line (watch, ...)
+        """
+        path, _ = QtWidgets.QFileDialog.getSaveFileName(self, "Export model", "", "Model (*.joblib)")
+        if path != '':
+            wk.export_model(path, self.clf, self.feat_func)
+            self.statusbar.showMessage(f'Model exported to {path}')
+
+    def save_project(self):
+        """
+        Save the categories, labels, parameters and model of the session
+        """
+        path, _ = QtWidgets.QFileDialog.getSaveFileName(self, "Save project", "",
+                                                        f"ForestPicTaker project (*{prj.PROJECT_EXTENSION})")
+        if path == '':
+            return
+
+        labels = self.viewer.get_labels()
+        categories = [(cat.name, cat.color.name(QtGui.QColor.HexArgb)) for cat in self.categories]
+        clf = self.clf if self.model_available else None
+        if self.project is not None:
+            # release the memory-mapped labels before overwriting them
+            self.project.release()
+
+        # the model is saved with the settings it was trained with, which may differ from the current ones
+        path = prj.save_project(path, self.image_path, categories, labels, self.feature_params,
+                                self.classifier_name, self.clf_params, clf,
+                                model_feature_params=dict(self.feat_func.keywords) if clf is not None else None,
+                                model_classifier=self.model_classifier)
+        self.statusbar.showMessage(f'Project saved to {path}')
+
+    def open_project(self):
+        """
+        Reopen a saved session: the image is shown first, labels and model are loaded afterwards
+        """
+        path = str(QtWidgets.QFileDialog.getExistingDirectory(self, "Open project"))
+        if path == '':
+            return
 
-                    dest_path = os.path.join(self.app_folder, f'segmented_{i}.jpg')
-                    io.imsave(dest_path, results)
+        try:
+            project = prj.Project(path)
+        except (OSError, ValueError) as e:
+            QtWidgets.QMessageBox.warning(self, 'Open project', f'{path} is not a valid project: {e}')
+            return
+        if not os.path.exists(project.image_path):
+            QtWidgets.QMessageBox.warning(self, 'Open project', f'Image not found: {project.image_path}')
+            return
+
+        self.load_image(project.image_path)
+        self.project = project
+        self.restore_labels = True
+        self.feature_params = dict(project.feature_params)
+        self.classifier_name = project.classifier
+        self.clf_params = dict(project.clf_params)
+
+        for name, color in project.categories:
+            self.create_category(name, QtGui.QColor(color))
+
+        self.actionRun.setEnabled(True)
+        self.actionTest.setEnabled(True)
+        self.actionReset_all.setEnabled(True)
+
+        if project.has_model:
+            self.feat_func = wk.get_features_func(**project.model_feature_params)
+            self.model_classifier = project.model_classifier
+            if project.model_feature_params == self.feature_params and project.model_classifier == self.classifier_name:
+                self.clf_name = self.classifier_name
+            else:
+                # the settings were changed after training: the next run trains a new model
+                self.clf_name = None
+            self.model_available = True
+            self.actionApply_to_folder.setEnabled(True)
+            self.actionWatch_folder.setEnabled(True)
+            self.actionExport_model.setEnabled(True)
+
+        # show the saved labels once the image is displayed
+        QtCore.QTimer.singleShot(0, self.show_saved_labels)
+
+    def show_saved_labels(self):
+        if self.base_labels is not None:
+            self.viewer.set_labels(self.base_labels, [cat.color for cat in self.categories])
 
     def on_cat_change(self):
         """
@@ -233,13 +710,26 @@ class WEKAWindow(QtWidgets.QMainWindow):
         """
         Launch the segmentation
         """
-        # load image
-        img = self.image_array
-        img = wk.rgba2rgb(img)
-        # generate training data
-        self.training_labels = wk.generate_training(img, self.categories)
-
-        self.clf, self.feat_func, results = wk.weka_segment(img, self.training_labels)
+        # load image, generate training data and features
+        try:
+            img = self.compute_features()
+        except wk.MemoryBudgetError as e:
+            QtWidgets.QMessageBox.warning(self, 'Memory budget', str(e))
+            return
+
+        if (self.refit_fraction < 1 and self.model_available and self.features is not None
+                and self.clf_name == self.classifier_name and wk.is_forest(self.clf)):
+            # partial retrain (chosen in the parameters): only part of the trees are regrown
+            self.clf = wk.refit_segmenter(self.clf, self.training_labels, self.features, self.refit_fraction)
+            results = future.predict_segmenter(self.features, self.clf)
+        else:
+            self.clf, self.feat_func, results = wk.weka_segment(img, self.training_labels, features=self.features,
+                                                                classifier=self.classifier_name,
+                                                                clf_params=self.clf_params,
+                                                                memory_budget=self.memory_budget,
+                                                                **self.feature_params)
+            self.clf_name = self.classifier_name
+            self.model_classifier = self.classifier_name
         dest_path = self.image_path[:-4] + 'segmented.jpg'
 
         #results = skimage.color.label2rgb(results)
@@ -255,6 +745,23 @@ class WEKAWindow(QtWidgets.QMainWindow):
 
         self.model_available = True
         self.actionApply_to_folder.setEnabled(True)
+        self.actionWatch_folder.setEnabled(True)
+        self.actionExport_model.setEnabled(True)
+        # the uncertainty map needs the features of the whole image
+        self.actionUncertainty.setEnabled(self.features is not None)
+        self.show_uncertainty()
+
+    def show_uncertainty(self):
+        """
+        Show the regions where the forest is the least confident, to guide the next ROIs
+        """
+        if not self.actionUncertainty.isChecked() or not self.model_available or self.features is None:
+            self.viewer.set_uncertainty(None)
+            return
+
+        changed = self.uncertainty.update(self.clf, self.features, self.training_labels)
+        print(f'{len(changed)} tiles of the uncertainty map were updated')
+        self.viewer.set_uncertainty(self.uncertainty.confidence, self.uncertainty.lowest_confidence())
 
     def generate_multi_outputs(self):
         """
@@ -267,7 +774,7 @@ class WEKAWindow(QtWidgets.QMainWindow):
         test_sigma_max = [4, 16]
 
         if self.training_labels == None:
-            self.training_labels = wk.generate_training(img, self.categories)
+            self.training_labels = self.viewer.get_labels()
 
         for test_e in test_edges:
             for test_s_min in test_sigma_min:
@@ -294,30 +801,36 @@ class WEKAWindow(QtWidgets.QMainWindow):
             color = QtWidgets.QColorDialog.getColor()
             print(color.rgb())
             if color.isValid():
-                # add category to combobox
-                self.comboBox_cat.addItem(text)
-                self.comboBox_cat.setEnabled(True)
+                self.create_category(text, color)
+
+    def create_category(self, text, color):
+        """
+        Create a segmentation category and add it to the interface
+        """
+        # add category to combobox
+        self.comboBox_cat.addItem(text)
+        self.comboBox_cat.setEnabled(True)
 
-                # add header to ROI list
-                self.add_item_in_tree(self.model, text)
-                self.model.setHeaderData(0, QtCore.Qt.Horizontal, 'Categories')
+        # add header to ROI list
+        self.add_item_in_tree(self.model, text)
+        self.model.setHeaderData(0, QtCore.Qt.Horizontal, 'Categories')
 
-                # create category class
-                cat = PixelCategory()
-                cat.name = text
-                cat.color = color
+        # create category class
+        cat = PixelCategory()
+        cat.name = text
+        cat.color = color
 
-                # add classification category to list of categories
-                self.categories.append(cat)
+        # add classification category to list of categories
+        self.categories.append(cat)
 
-                # activate tools
-                self.actionBrush.setEnabled(True)
-                self.actionRectangle_selection.setEnabled(True)
+        # activate tools
+        self.actionBrush.setEnabled(True)
+        self.actionRectangle_selection.setEnabled(True)
 
-                # select new cat in combobox
-                nb_cat = len(self.categories)
-                self.comboBox_cat.setCurrentIndex(nb_cat-1)
-                self.on_cat_change()
+        # select new cat in combobox
+        nb_cat = len(self.categories)
+        self.comboBox_cat.setCurrentIndex(nb_cat-1)
+        self.on_cat_change()
 
     def add_roi_brush(self, nb):
         """
@@ -442,6 +955,7 @@ class WEKAWindow(QtWidgets.QMainWindow):
         self.pushButton_addCat.setEnabled(True)
         self.actionHand_selector.setEnabled(True)
         self.actionHand_selector.setChecked(True)
+        self.actionSave_project.setEnabled(True)
 
 
     def add_item_in_tree(self, parent, line):
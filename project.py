@@ -0,0 +1,165 @@
+"""
+Project files, to save a labelling session and reopen it later.
+
+A project is a folder (*.fpt) containing:
+- project.json: image reference, categories and colours, feature and classifier parameters
+  (current settings, and the settings the model was trained with)
+- labels.npy: label mask, cropped to the labelled area (uint8, can be memory-mapped)
+- model.joblib: fitted model (optional, compressed)
+
+When a project is opened, only project.json is read. The label mask and the model are loaded
+the first time they are accessed, so that the image can be shown right away.
+"""
+import json
+import os
+from functools import cached_property
+
+import joblib
+import numpy as np
+
+PROJECT_EXTENSION = '.fpt'
+VERSION = 1
+
+
+def save_project(path, image_path, categories, labels, feature_params, classifier, clf_params, clf=None,
+                 model_feature_params=None, model_classifier=None):
+    """
+    Save a labelling session
+    :param path: project folder
+    :param categories: list of (name, colour as '#aarrggbb')
+    :param labels: label mask of the image (0 = unlabelled)
+    :param feature_params, classifier, clf_params: current settings (used for the next training)
+    :param clf: fitted classifier, if any
+    :param model_feature_params: feature settings the classifier was trained with
+    :param model_classifier: name of the classifier (key of weka.CLASSIFIERS)
+    """
+    if clf is not None and model_feature_params is None:
+        raise ValueError('model_feature_params are needed to save a model')
+    if not path.endswith(PROJECT_EXTENSION):
+        path += PROJECT_EXTENSION
+    os.makedirs(path, exist_ok=True)
+
+    # only the labelled area is stored
+    rows, cols = np.nonzero(labels)
+    if len(rows):
+        offset = [int(rows.min()), int(cols.min())]
+        crop = labels[offset[0]:rows.max() + 1, offset[1]:cols.max() + 1]
+    else:
+        # empty arrays cannot be memory-mapped
+        offset = [0, 0]
+        crop = np.zeros((1, 1), dtype=np.uint8)
+    np.save(os.path.join(path, 'labels.npy'), np.ascontiguousarray(crop, dtype=np.uint8))
+
+    model_file = os.path.join(path, 'model.joblib')
+    if clf is not None:
+        joblib.dump(clf, model_file, compress=3)
+    elif os.path.exists(model_file):
+        os.remove(model_file)
+
+    # image path relative to the project, so that both can be moved together
+    try:
+        image_ref = os.path.relpath(image_path, path)
+    except ValueError:
+        # not on the same drive (Windows)
+        image_ref = os.path.abspath(image_path)
+
+    meta = {'version': VERSION,
+            'image': image_ref,
+            'shape': list(labels.shape),
+            'labels_offset': offset,
+            'categories': [{'name': name, 'color': color} for name, color in categories],
+            'feature_params': feature_params,
+            'classifier': classifier,
+            'clf_params': clf_params,
+            'has_model': clf is not None,
+            'model_feature_params': model_feature_params,
+            'model_classifier': model_classifier}
+    with open(os.path.join(path, 'project.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    return path
+
+
+class Project:
+    """
+    A saved labelling session, loaded lazily
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'project.json')) as f:
+            self.meta = json.load(f)
+
+    @property
+    def image_path(self):
+        return os.path.normpath(os.path.join(self.path, self.meta['image']))
+
+    @property
+    def categories(self):
+        """
+        :return: list of (name, colour as '#aarrggbb')
+        """
+        return [(c['name'], c['color']) for c in self.meta['categories']]
+
+    @staticmethod
+    def _feature_params(params):
+        params = dict(params)
+        # JSON has no tuples
+        params['banks'] = tuple(params.get('banks', ()))
+        return params
+
+    @property
+    def feature_params(self):
+        return self._feature_params(self.meta['feature_params'])
+
+    @property
+    def model_feature_params(self):
+        """
+        Feature settings of the saved model (the current settings for older projects)
+        """
+        return self._feature_params(self.meta.get('model_feature_params') or self.meta['feature_params'])
+
+    @property
+    def model_classifier(self):
+        return self.meta.get('model_classifier') or self.meta['classifier']
+
+    @property
+    def classifier(self):
+        return self.meta['classifier']
+
+    @property
+    def clf_params(self):
+        return self.meta['clf_params']
+
+    @property
+    def has_model(self):
+        return self.meta['has_model']
+
+    @cached_property
+    def labels_crop(self):
+        """
+        Stored part of the label mask, memory-mapped
+        """
+        return np.load(os.path.join(self.path, 'labels.npy'), mmap_mode='r')
+
+    @cached_property
+    def labels(self):
+        """
+        Label mask of the whole image
+        """
+        labels = np.zeros(self.meta['shape'], dtype=np.uint8)
+        crop = self.labels_crop
+        y, x = self.meta['labels_offset']
+        labels[y:y + crop.shape[0], x:x + crop.shape[1]] = crop
+        return labels
+
+    def release(self):
+        """
+        Close the memory-mapped label file (needed before overwriting the project)
+        """
+        self.__dict__.pop('labels_crop', None)
+
+    @cached_property
+    def model(self):
+        if not self.has_model:
+            return None
+        return joblib.load(os.path.join(self.path, 'model.joblib'))
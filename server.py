@@ -0,0 +1,294 @@
+"""
+Local segmentation service, keeping the models in memory between requests.
+
+Endpoints:
+    POST /segment?model=NAME&format=png|npy
+        body: image bytes, or JSON {"path": "/path/to/image.jpg"}
+        answer: label map (uint8, 0 = unlabelled) as PNG or .npy
+    GET /models
+    GET /metrics
+
+Features are computed in the request threads (at most `workers` at a time). The feature
+rows of concurrent requests are then gathered in a batch and predicted with one call to
+the classifier, which amortizes its overhead over several images.
+"""
+import io as pyio
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import imageio.v3 as iio
+import numpy as np
+
+import weka as wk
+
+
+class Batcher:
+    """
+    Gather the prediction requests of one model and run them together
+    """
+    def __init__(self, clf, max_batch_pixels=4_000_000, max_wait=0.02):
+        """
+        :param max_batch_pixels: a batch is run as soon as it reaches this number of pixels
+        :param max_wait: maximum time a request waits for others to join its batch [s]
+        """
+        self.clf = clf
+        self.max_batch_pixels = max_batch_pixels
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self._carry = None  # request that did not fit in the previous batch
+        self.n_batches = 0
+        self.n_batched = 0
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def predict(self, features):
+        """
+        :param features: features array (H x W x F)
+        :return: Future of the label array (H x W)
+        """
+        fut = Future()
+        self.requests.put((features, fut))
+        return fut
+
+    def _run(self):
+        while True:
+            batch = [self._carry if self._carry is not None else self.requests.get()]
+            self._carry = None
+            n_pixels = batch[0][0].shape[0] * batch[0][0].shape[1]
+            deadline = time.perf_counter() + self.max_wait
+            while n_pixels < self.max_batch_pixels:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                item_pixels = item[0].shape[0] * item[0].shape[1]
+                if n_pixels + item_pixels > self.max_batch_pixels:
+                    # the concatenated copy never exceeds max_batch_pixels
+                    self._carry = item
+                    break
+                batch.append(item)
+                n_pixels += item_pixels
+
+            try:
+                if len(batch) == 1:
+                    X = batch[0][0].reshape(-1, batch[0][0].shape[-1])
+                else:
+                    X = np.concatenate([f.reshape(-1, f.shape[-1]) for f, _ in batch])
+                labels = self.clf.predict(X).astype(np.uint8)
+            except Exception as e:
+                for _, fut in batch:
+                    fut.set_exception(e)
+                continue
+
+            start = 0
+            for f, fut in batch:
+                n = f.shape[0] * f.shape[1]
+                fut.set_result(labels[start:start + n].reshape(f.shape[:2]))
+                start += n
+            self.n_batches += 1
+            self.n_batched += len(batch)
+
+
+class SegmentationService:
+    """
+    Resident models, worker pool and metrics
+    """
+    def __init__(self, model_paths, workers=None, memory_budget=None, max_batch_pixels=4_000_000, max_wait=0.02):
+        """
+        :param model_paths: dict name -> model file (saved with export_model)
+        :param workers: number of images whose features are computed at the same time
+        """
+        self.workers = workers or os.cpu_count()
+        self.slots = threading.Semaphore(self.workers)
+        self.models = {}
+        batch_bytes = 0
+        for name, path in model_paths.items():
+            clf, features_func = wk.load_model(path)
+            self.models[name] = (clf, features_func, Batcher(clf, max_batch_pixels, max_wait))
+            # copy of the features made when a batch is concatenated (float32)
+            batch_bytes += max_batch_pixels * wk.n_features(**features_func.keywords) * 4
+            print(f'model {name} loaded from {path}')
+
+        # each worker can hold the features of one image, besides the batches of each model
+        budget = (memory_budget or wk.default_memory_budget()) - batch_bytes
+        if budget <= 0:
+            raise wk.MemoryBudgetError(f'The batches need {batch_bytes / 1e9:.2f} GB, '
+                                       f'increase the memory budget or decrease max_batch_pixels')
+        self.memory_budget = budget // self.workers
+
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=1000)
+        self.n_requests = 0
+        self.n_errors = 0
+        self.megapixels = 0.
+        self.start_time = time.perf_counter()
+
+    def segment(self, img_array, model=None):
+        """
+        :return: label array (H x W)
+        """
+        name = model or next(iter(self.models))
+        if name not in self.models:
+            raise KeyError(f'unknown model {name}')
+        clf, features_func, batcher = self.models[name]
+
+        img_array = wk.rgba2rgb(img_array)
+        params = features_func.keywords
+        with self.slots:
+            plan = wk.plan_memory(img_array.shape, params, n_classes=len(clf.classes_), budget=self.memory_budget)
+            if plan['tile_size'] is not None:
+                # too large to be batched with others
+                return wk.predict_image(img_array, clf, features_func, plan['tile_size'],
+                                        wk.feature_margin(**params))
+            features = features_func(img_array)
+            # the slot is kept until the prediction, as the batch holds the features
+            return batcher.predict(features).result()
+
+    def record(self, latency, n_pixels, error=False):
+        with self.lock:
+            self.n_requests += 1
+            self.n_errors += int(error)
+            if not error:
+                self.latencies.append(latency)
+                self.megapixels += n_pixels / 1e6
+
+    def metrics(self):
+        with self.lock:
+            lat = np.array(self.latencies) if self.latencies else np.zeros(1)
+            elapsed = time.perf_counter() - self.start_time
+            return {'requests': self.n_requests,
+                    'errors': self.n_errors,
+                    'latency_p50': float(np.percentile(lat, 50)),
+                    'latency_p95': float(np.percentile(lat, 95)),
+                    'megapixels_per_s': self.megapixels / elapsed,
+                    'batches': {name: {'batches': b.n_batches,
+                                       'mean_size': b.n_batched / b.n_batches if b.n_batches else 0.}
+                                for name, (_, _, b) in self.models.items()}}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    service = None
+    chunk_size = 1 << 16
+
+    def address_string(self):
+        # unix sockets have no client address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def send_json(self, obj, status=200):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/metrics':
+            self.send_json(self.service.metrics())
+        elif path == '/models':
+            self.send_json({name: {'classes': [int(c) for c in clf.classes_], 'features': features_func.keywords}
+                            for name, (clf, features_func, _) in self.service.models.items()})
+        else:
+            self.send_json({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/segment':
+            self.send_json({'error': 'not found'}, 404)
+            return
+        query = parse_qs(url.query)
+        model = query.get('model', [None])[0]
+        fmt = query.get('format', ['png'])[0]
+
+        if model is not None and model not in self.service.models:
+            self.service.record(0, 0, error=True)
+            self.send_json({'error': f'unknown model {model}'}, 404)
+            return
+
+        t0 = time.perf_counter()
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                request = json.loads(body)
+                if not isinstance(request, dict) or not isinstance(request.get('path'), str):
+                    raise ValueError('JSON body must be {"path": "/path/to/image"}')
+                img = iio.imread(request['path'])
+            else:
+                img = iio.imread(body)
+        except Exception as e:
+            self.service.record(0, 0, error=True)
+            self.send_json({'error': str(e)}, 400)
+            return
+
+        try:
+            labels = self.service.segment(img, model)
+        except Exception as e:
+            self.service.record(0, 0, error=True)
+            self.send_json({'error': str(e)}, 400)
+            return
+
+        buf = pyio.BytesIO()
+        if fmt == 'npy':
+            np.save(buf, labels)
+            content_type = 'application/octet-stream'
+        else:
+            iio.imwrite(buf, labels, extension='.png')
+            content_type = 'image/png'
+        data = buf.getbuffer()
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        for start in range(0, len(data), self.chunk_size):
+            self.wfile.write(data[start:start + self.chunk_size])
+        self.service.record(time.perf_counter() - t0, labels.size)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def serve(service, host='127.0.0.1', port=8765, unix_socket=None):
+    """
+    Run the service until interrupted
+    :param unix_socket: path of a unix socket, used instead of host/port
+    """
+    handler = type('Handler', (RequestHandler,), {'service': service})
+    if unix_socket:
+        httpd = ThreadingUnixHTTPServer(unix_socket, handler)
+        print(f'listening on {unix_socket}')
+    else:
+        httpd = ThreadingHTTPServer((host, port), handler)
+        print(f'listening on http://{host}:{port}')
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        if unix_socket and os.path.exists(unix_socket):
+            os.remove(unix_socket)
@@ -0,0 +1,267 @@
+"""
+Streaming segmentation of a watched folder, for images that are being offloaded from a drone.
+
+New images are detected by polling the folder, and only queued once their size is stable
+(the copy is finished). They then go through a pipeline of threads (decode -> features ->
+predict -> write) linked by bounded queues: when a stage is slower than the others, the
+queues fill up and the previous stages wait, so that memory use stays bounded.
+"""
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+import numpy as np
+import tifffile
+from skimage import io, color
+
+import weka as wk
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff')
+
+_STOP = object()
+
+
+def list_images(folder):
+    return sorted(os.path.join(folder, f) for f in os.listdir(folder)
+                  if f.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def output_path(out_folder, path, output='labels'):
+    """
+    :param output: key of weka.OUTPUTS
+    """
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if output == 'labels':
+        return os.path.join(out_folder, f'segmented_{stem}.jpg')
+    return os.path.join(out_folder, f'{output}_{stem}.tif')
+
+
+def save_segmentation(result, dest_path):
+    """
+    Save a label array as a colour image
+    """
+    io.imsave(dest_path, (color.label2rgb(result) * 255).astype(np.uint8), check_contrast=False)
+
+
+def output_description(output, classes):
+    """
+    Meaning of the bands of a 'proba' or 'top1' output, stored as JSON in the TIFF description
+    :param classes: classes of the classifier (clf.classes_), in the order of the 'proba' bands
+    """
+    classes = [int(c) for c in classes]
+    if output == 'proba':
+        bands = [f'probability of class {c}' for c in classes]
+    else:
+        bands = ['label', 'confidence (probability of the label)']
+    return json.dumps({'output': output, 'classes': classes, 'bands': bands, 'scale': 255})
+
+
+def save_output(result, dest_path, output='labels', classes=None):
+    """
+    Save the result of weka.predict_image: colour image for labels, compressed
+    multi-band uint8 TIFF for probabilities
+    :param classes: classes of the classifier (clf.classes_), recorded in the TIFF description
+    """
+    if output == 'labels':
+        save_segmentation(result, dest_path)
+    else:
+        tifffile.imwrite(dest_path, result, compression='zlib', photometric='minisblack', planarconfig='contig',
+                         description=output_description(output, classes), metadata=None)
+
+
+class FolderWatcher:
+    """
+    Poll a folder and report the images whose size did not change during `stable_checks` polls
+    """
+    def __init__(self, folder, interval=1.0, stable_checks=2):
+        self.folder = folder
+        self.interval = interval
+        self.stable_checks = stable_checks
+        self.sizes = {}  # path -> (size, number of polls with this size)
+        self.seen = set()
+
+    def poll(self):
+        """
+        :return: list of the new images whose copy is finished
+        """
+        ready = []
+        for path in list_images(self.folder):
+            if path in self.seen:
+                continue
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                # removed or renamed in the meantime
+                continue
+            last_size, count = self.sizes.get(path, (None, 0))
+            count = count + 1 if size == last_size and size > 0 else 0
+            self.sizes[path] = (size, count)
+            if count >= self.stable_checks:
+                ready.append(path)
+                self.seen.add(path)
+                del self.sizes[path]
+        return ready
+
+
+class StreamingSegmenter:
+    """
+    Bounded producer/consumer pipeline: decode -> features -> predict -> write
+    """
+    stages = ['decode', 'features', 'predict', 'write']
+
+    def __init__(self, clf, features_func, out_folder, queue_size=2, memory_budget=None, output='labels'):
+        """
+        :param queue_size: maximum number of images waiting in front of each stage
+        :param memory_budget: RAM budget (bytes) of the pipeline. Up to queue_size + 2 feature stacks
+            exist at the same time (one waiting to enter the predict queue, queue_size in it, one being
+            predicted), so each image is planned with a share of the budget; larger images are processed by tiles
+        :param output: key of weka.OUTPUTS
+        """
+        self.clf = clf
+        self.output = output
+        self.features_func = features_func
+        self.out_folder = out_folder
+        self.memory_budget = (memory_budget or wk.default_memory_budget()) // (queue_size + 2)
+        self.queues = {stage: queue.Queue(maxsize=queue_size) for stage in self.stages}
+        self.threads = []
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.megapixels = 0.
+        self.stage_time = {stage: 0. for stage in self.stages}
+        self.start_time = None
+        self.watcher_thread = None
+        self.stop_event = threading.Event()
+
+        os.makedirs(out_folder, exist_ok=True)
+
+    # stages, each one takes an item from its queue and returns the item for the next stage
+    def _decode(self, path):
+        img = wk.rgba2rgb(io.imread(path))
+        return path, img
+
+    def _features(self, item):
+        path, img = item
+        params = self.features_func.keywords
+        plan = wk.plan_memory(img.shape, params, n_classes=len(self.clf.classes_), budget=self.memory_budget)
+        features = self.features_func(img) if plan['tile_size'] is None else None
+        return path, img, features, plan['tile_size']
+
+    def _predict(self, item):
+        path, img, features, tile_size = item
+        if features is None:
+            result = wk.predict_image(img, self.clf, self.features_func, tile_size,
+                                      wk.feature_margin(**self.features_func.keywords), self.output)
+        else:
+            result = wk.predict_features(features, self.clf, self.output)
+        return path, img.shape, result
+
+    def _write(self, item):
+        path, shape, result = item
+        save_output(result, output_path(self.out_folder, path, self.output), self.output, self.clf.classes_)
+        with self.lock:
+            self.processed += 1
+            self.megapixels += shape[0] * shape[1] / 1e6
+        print(f'{path} segmented')
+
+    def _worker(self, stage, func, next_queue):
+        q = self.queues[stage]
+        while True:
+            item = q.get()
+            if item is _STOP:
+                if next_queue is not None:
+                    next_queue.put(_STOP)
+                break
+            t0 = time.perf_counter()
+            try:
+                out = func(item)
+            except Exception as e:
+                # a corrupted or unreadable image must not stop the stream
+                print(f'{stage} failed: {e}')
+                with self.lock:
+                    self.failed += 1
+                continue
+            finally:
+                with self.lock:
+                    self.stage_time[stage] += time.perf_counter() - t0
+            if next_queue is not None:
+                # blocks when the next stage is late (back-pressure)
+                next_queue.put(out)
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        funcs = [self._decode, self._features, self._predict, self._write]
+        for i, stage in enumerate(self.stages):
+            next_queue = self.queues[self.stages[i + 1]] if i + 1 < len(self.stages) else None
+            t = threading.Thread(target=self._worker, args=(stage, funcs[i], next_queue), daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, path, timeout=None):
+        """
+        Add an image to the pipeline (blocks while the pipeline is full)
+        :param timeout: maximum waiting time [s]
+        :return: False if the pipeline stayed full
+        """
+        try:
+            self.queues['decode'].put(path, timeout=timeout)
+        except queue.Full:
+            return False
+        return True
+
+    def watch(self, folder, interval=1.0, stable_checks=2):
+        """
+        Watch a folder in a background thread and submit its new images
+        """
+        watcher = FolderWatcher(folder, interval, stable_checks)
+
+        def run():
+            pending = deque()
+            try:
+                while not self.stop_event.is_set():
+                    pending.extend(watcher.poll())
+                    # short waits, so that a stop request is seen even when the pipeline is full
+                    while pending and not self.stop_event.is_set():
+                        if self.submit(pending[0], timeout=0.2):
+                            pending.popleft()
+                    self.stop_event.wait(interval)
+            finally:
+                # the watcher is the producer: it closes the pipeline
+                self.queues['decode'].put(_STOP)
+
+        if self.start_time is None:
+            self.start()
+        self.watcher_thread = threading.Thread(target=run, daemon=True)
+        self.watcher_thread.start()
+
+    def stop(self, wait=True):
+        """
+        Stop watching, and let the images already in the pipeline finish
+        :param wait: wait for the end of the pipeline. With False, the call returns immediately
+            (e.g. from the GUI thread), the pipeline is closed by a background thread.
+        """
+        self.stop_event.set()
+        if self.watcher_thread is None:
+            # the decode queue may be full: do not block the caller
+            threading.Thread(target=self.queues['decode'].put, args=(_STOP,), daemon=True).start()
+        if wait:
+            if self.watcher_thread is not None:
+                self.watcher_thread.join()
+            for t in self.threads:
+                t.join()
+
+    def stats(self):
+        """
+        Queue depths and throughput of the pipeline
+        """
+        elapsed = time.perf_counter() - self.start_time if self.start_time else 0.
+        with self.lock:
+            return {'queued': {stage: q.qsize() for stage, q in self.queues.items()},
+                    'processed': self.processed,
+                    'failed': self.failed,
+                    'images_per_min': 60 * self.processed / elapsed if elapsed else 0.,
+                    'megapixels_per_s': self.megapixels / elapsed if elapsed else 0.,
+                    'stage_time': dict(self.stage_time)}
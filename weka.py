@@ -1,9 +1,79 @@
-from skimage import io,data, segmentation, feature, future
-from sklearn.ensemble import RandomForestClassifier
+from skimage import io,data, segmentation, feature, future, util, color
+from sklearn.ensemble import RandomForestClassifier, ExtraTreesClassifier, HistGradientBoostingClassifier
+from sklearn.linear_model import LogisticRegression
+from sklearn.neural_network import MLPClassifier
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
+import itertools
+import joblib
+import os
+import pickle
+import threading
+import time
+import tracemalloc
+import zlib
 import numpy as np
 
 
+def _linear(**params):
+    return make_pipeline(StandardScaler(), LogisticRegression(**params))
+
+
+def _mlp(**params):
+    return make_pipeline(StandardScaler(), MLPClassifier(**params))
+
+
+# name -> (constructor, default parameters)
+CLASSIFIERS = {
+    'RandomForest': (RandomForestClassifier,
+                     dict(n_estimators=50, n_jobs=-1, max_depth=10, max_samples=0.05)),
+    'ExtraTrees': (ExtraTreesClassifier,
+                   dict(n_estimators=50, n_jobs=-1, max_depth=10, bootstrap=True, max_samples=0.05)),
+    'HistGradientBoosting': (HistGradientBoostingClassifier,
+                             dict(max_iter=50, max_depth=10, early_stopping=False)),
+    'Linear': (_linear, dict(max_iter=200)),
+    'MLP': (_mlp, dict(hidden_layer_sizes=(32,), max_iter=50, early_stopping=True)),
+}
+DEFAULT_CLASSIFIER = 'RandomForest'
+
+DEFAULT_FEATURE_PARAMS = dict(sigma_min=1, sigma_max=16, edges=False, texture=True, banks=())
+
+# values tested by autotune
+SEARCH_SPACE = {
+    'sigma_min': [0.5, 1, 2],
+    'sigma_max': [8, 16],
+    'edges': [False, True],
+    'texture': [True],
+    'n_estimators': [25, 50],
+    'max_depth': [8, 12],
+    'banks': [(), ('exg', 'vari', 'gli')],
+}
+FEATURE_KEYS = list(DEFAULT_FEATURE_PARAMS)
+
+
+def make_classifier(name=DEFAULT_CLASSIFIER, **params):
+    """
+    Create an (unfitted) classifier from the registry
+    :param name: key of CLASSIFIERS
+    :param params: parameters overriding the defaults
+    """
+    if name not in CLASSIFIERS:
+        raise ValueError(f'Unknown classifier {name}, choose among {list(CLASSIFIERS)}')
+    constructor, defaults = CLASSIFIERS[name]
+    kwargs = dict(defaults)
+    kwargs.update(params)
+    return constructor(**kwargs)
+
+
+def is_forest(clf):
+    """
+    True for the forests of decision trees, which can be retrained by parts (refit_segmenter)
+    """
+    return isinstance(clf, (RandomForestClassifier, ExtraTreesClassifier))
+
+
 def rgba2rgb(rgba, background=(255, 255, 255)):
     row, col, ch = rgba.shape
 
@@ -26,37 +96,317 @@ def rgba2rgb(rgba, background=(255, 255, 255)):
     return np.asarray( rgb, dtype='uint8' )
 
 
-def generate_training(img_array, categories):
-    training_labels = np.zeros(img_array.shape[:2], dtype=np.uint8)
+def _chromatic(rgb):
+    # normalized r, g, b: robust to illumination changes
+    total = rgb.sum(axis=-1)
+    total[total == 0] = 1
+    return [rgb[..., i] / total for i in range(3)]
+
+
+def _exg(rgb, out):
+    r, g, b = _chromatic(rgb)
+    np.subtract(2 * g, r, out=out[..., 0])
+    out[..., 0] -= b
+
+
+def _vari(rgb, out):
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    den = g + r - b
+    den[np.abs(den) < 1e-3] = 1e-3
+    np.divide(g - r, den, out=out[..., 0])
+    # unbounded when the denominator is small
+    np.clip(out[..., 0], -1, 1, out=out[..., 0])
+
+
+def _gli(rgb, out):
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    den = 2 * g + r + b
+    den[den == 0] = 1
+    np.divide(2 * g - r - b, den, out=out[..., 0])
+
+
+def _hsv(rgb, out):
+    out[...] = color.rgb2hsv(rgb)
+
+
+def _lab(rgb, out):
+    out[...] = color.rgb2lab(rgb) / np.array([100, 128, 128], dtype=np.float32)
+
+
+# name -> (function filling the output channels from a float RGB image, number of channels)
+FEATURE_BANKS = {
+    'exg': (_exg, 1),  # excess green
+    'vari': (_vari, 1),  # visible atmospherically resistant index
+    'gli': (_gli, 1),  # green leaf index
+    'hsv': (_hsv, 3),
+    'lab': (_lab, 3),
+}
+
+
+def compute_banks(img_array, banks, out=None, chunk_rows=256):
+    """
+    Per-pixel colour features (vegetation indices, colour spaces)
+    Computed by blocks of rows, so that the temporary arrays stay small and in cache.
+    :param img_array: float RGB image (H x W x 3), values in [0, 1]
+    :param banks: names of FEATURE_BANKS
+    :param out: array (H x W x n) to fill, created if None
+    :return: features array (H x W x n)
+    """
+    n = sum(FEATURE_BANKS[name][1] for name in banks)
+    if out is None:
+        out = np.empty(img_array.shape[:2] + (n,), dtype=np.float32)
+    for y in range(0, img_array.shape[0], chunk_rows):
+        rgb = img_array[y:y + chunk_rows, :, :3]
+        k = 0
+        for name in banks:
+            func, size = FEATURE_BANKS[name]
+            func(rgb, out[y:y + chunk_rows, :, k:k + size])
+            k += size
+    return out
+
+
+def compute_features(img_array, sigma_min=1, sigma_max=16, edges=False, texture=True, banks=(), dtype=np.float32):
+    """
+    Multiscale intensity, edges and texture features, followed by the colour features of `banks`
+    :param dtype: float32 by default, which halves the memory compared to float64
+    :return: features array (H x W x F)
+    """
+    if dtype == np.float32:
+        img_array = util.img_as_float32(img_array)
+    else:
+        img_array = util.img_as_float(img_array)
+    features = feature.multiscale_basic_features(img_array, intensity=True, edges=edges, texture=texture,
+                                                 sigma_min=sigma_min, sigma_max=sigma_max,
+                                                 channel_axis=-1)
+    if not banks:
+        return features.astype(dtype, copy=False)
+
+    n_ms = features.shape[-1]
+    n = n_ms + sum(FEATURE_BANKS[name][1] for name in banks)
+    out = np.empty(features.shape[:2] + (n,), dtype=dtype)
+    out[..., :n_ms] = features
+    del features
+    compute_banks(img_array, banks, out=out[..., n_ms:])
+    return out
+
+
+def get_features_func(sigma_min=1, sigma_max=16, edges=False, texture=True, banks=()):
+    """
+    Build the feature function used for training and prediction
+    """
+    return partial(compute_features, edges=edges, texture=texture,
+                   sigma_min=sigma_min, sigma_max=sigma_max, banks=tuple(banks))
+
+
+class MemoryBudgetError(MemoryError):
+    """
+    Raised when an image cannot be processed within the memory budget, even by tiles
+    """
+
+
+def default_memory_budget(fraction=0.5):
+    """
+    Part of the physical memory of the computer, in bytes (4 GB if unknown)
+    """
+    try:
+        total = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        # not available on Windows
+        total = 8e9
+    return int(total * fraction)
+
+
+def n_features(n_channels=3, sigma_min=1, sigma_max=16, edges=False, texture=True, banks=(), **kwargs):
+    """
+    Number of features given by compute_features
+    """
+    n_sigmas = int(np.log2(sigma_max) - np.log2(sigma_min) + 1)
+    per_sigma = 1 + int(edges) + 2 * int(texture)
+    return n_channels * n_sigmas * per_sigma + sum(FEATURE_BANKS[name][1] for name in banks)
+
+
+def feature_margin(sigma_max=16, **kwargs):
+    """
+    Border added around tiles so that their features equal those of the full image
+    (gaussian filters are truncated at 4 sigma, and the texture features take two
+    gradients of the smoothed image, each reaching one more pixel)
+    """
+    return int(np.ceil(4 * sigma_max)) + 2
+
+
+def estimate_memory(shape, feature_params, n_classes=2, n_jobs=None, itemsize=4):
+    """
+    Estimate the peak memory of computing the features and predicting an image
+    :param shape: (H, W) or (H, W, C) of the image
+    :param feature_params: sigma_min, sigma_max, edges, texture, banks
+    :param n_classes: number of categories
+    :param n_jobs: number of threads used by the classifier
+    :param itemsize: 4 for float32 features, 8 for float64
+    :return: peak memory, in bytes
+    """
+    n_pixels = shape[0] * shape[1]
+    n_channels = shape[2] if len(shape) > 2 else 1
+    n_feat = n_features(n_channels, **feature_params)
+    n_jobs = n_jobs or os.cpu_count()
+
+    image = n_pixels * n_channels * itemsize
+    # features are built as a list of arrays, then stacked
+    features = 2 * n_pixels * n_feat * itemsize
+    # probabilities of the forest: one float64 accumulator, plus one array per thread
+    predict = n_pixels * n_feat * itemsize + (1 + n_jobs) * n_pixels * n_classes * 8 + n_pixels * 8
+    return image + max(features, predict)
+
+
+def plan_memory(shape, feature_params, n_classes=2, budget=None, n_jobs=None, min_tile=256):
+    """
+    Choose how to process an image within a memory budget
+    :return: dict with the estimated peak memory and the tile size (None = whole image)
+    """
+    budget = budget or default_memory_budget()
+    peak = estimate_memory(shape, feature_params, n_classes, n_jobs)
+    plan = {'peak_bytes': peak, 'budget_bytes': budget, 'tile_size': None}
+    if peak <= budget:
+        return plan
+
+    margin = feature_margin(**feature_params)
+    tile_peak = peak
+    tile = max(shape[0], shape[1])
+    while tile > min_tile:
+        tile = max(min_tile, tile // 2)
+        tile_shape = (min(tile, shape[0]) + 2 * margin, min(tile, shape[1]) + 2 * margin) + tuple(shape[2:])
+        tile_peak = estimate_memory(tile_shape, feature_params, n_classes, n_jobs)
+        if tile_peak <= budget:
+            plan.update(peak_bytes=tile_peak, tile_size=tile)
+            return plan
+
+    raise MemoryBudgetError(f'Image of shape {shape} needs {peak / 1e9:.1f} GB, and {tile_peak / 1e9:.1f} GB '
+                            f'with tiles of {min_tile} px, but the budget is {budget / 1e9:.1f} GB')
+
+
+def iter_tiles(shape, tile_size, margin):
+    """
+    Tiles of an image, with a border
+    :return: generator of (tile slices, tile slices with border, tile slices within the bordered tile)
+    """
+    h, w = shape[:2]
+    for y in range(0, h, tile_size):
+        for x in range(0, w, tile_size):
+            y0, x0 = max(0, y - margin), max(0, x - margin)
+            y1, x1 = min(h, y + tile_size + margin), min(w, x + tile_size + margin)
+            inner = (slice(y, min(h, y + tile_size)), slice(x, min(w, x + tile_size)))
+            outer = (slice(y0, y1), slice(x0, x1))
+            local = (slice(y - y0, inner[0].stop - y0), slice(x - x0, inner[1].stop - x0))
+            yield inner, outer, local
+
+
+def training_data_tiled(img_array, training_labels, features_func, tile_size, margin):
+    """
+    Features of the labelled pixels only, computed tile by tile
+    :return: X (n_labelled x F), y (n_labelled)
+    """
+    X, y = [], []
+    for inner, outer, local in iter_tiles(img_array.shape, tile_size, margin):
+        labels = training_labels[inner]
+        mask = labels > 0
+        if not mask.any():
+            continue
+        features = features_func(img_array[outer])[local]
+        X.append(features[mask])
+        y.append(labels[mask])
+    return np.concatenate(X), np.concatenate(y)
+
+
+# kinds of output of predict_image
+OUTPUTS = {
+    'labels': 'label of each pixel',
+    'proba': 'probability of each class, quantized to uint8 (0-255)',
+    'top1': 'label and confidence (probability of the label, 0-255) of each pixel',
+}
+
+
+def quantize_proba(proba):
+    return np.rint(proba * 255).astype(np.uint8)
+
+
+def predict_quantized(features, clf, output='proba', chunk_size=65536):
+    """
+    Probabilities of the classifier, by chunks of pixels so that the float
+    (n_pixels x n_classes) matrix is never allocated for the whole image
+    :param features: features array (H x W x F)
+    :param output: 'proba' (one band per class) or 'top1' (label and confidence)
+    :return: uint8 array (H x W x bands)
+    """
+    X = features.reshape(-1, features.shape[-1])
+    n_bands = len(clf.classes_) if output == 'proba' else 2
+    out = np.empty((X.shape[0], n_bands), dtype=np.uint8)
+    for start in range(0, X.shape[0], chunk_size):
+        proba = clf.predict_proba(X[start:start + chunk_size])
+        if output == 'proba':
+            out[start:start + chunk_size] = quantize_proba(proba)
+        else:
+            best = np.argmax(proba, axis=1)
+            out[start:start + chunk_size, 0] = clf.classes_.take(best)
+            out[start:start + chunk_size, 1] = quantize_proba(proba[np.arange(len(best)), best])
+    return out.reshape(features.shape[:2] + (n_bands,))
+
+
+def predict_features(features, clf, output='labels'):
+    """
+    :param features: features array (H x W x F)
+    :param output: key of OUTPUTS
+    """
+    if output == 'labels':
+        return future.predict_segmenter(features, clf)
+    return predict_quantized(features, clf, output)
+
+
+def predict_image(img_array, clf, features_func, tile_size=None, margin=0, output='labels'):
+    """
+    Segment an image, by tiles if tile_size is given
+    :param output: key of OUTPUTS
+    :return: label array (H x W), or uint8 array (H x W x bands) for 'proba' and 'top1'
+    """
+    if tile_size is None:
+        return predict_features(features_func(img_array), clf, output)
 
-    for i, cat in enumerate(categories):
-        for roi in cat.roi_list_rect:
-            start_x = int(roi[0].x())
-            start_y = int(roi[0].y())
-            end_x = int(roi[1].x())
-            end_y = int(roi[1].y())
+    result = None
+    for inner, outer, local in iter_tiles(img_array.shape, tile_size, margin):
+        features = features_func(img_array[outer])[local]
+        tile = predict_features(features, clf, output)
+        if result is None:
+            result = np.zeros(img_array.shape[:2] + tile.shape[2:], dtype=np.uint8)
+        result[inner] = tile
+    return result
 
-            training_labels[start_y:end_y, start_x:end_x] = i + 1
-        for roi in cat.roi_list_brush:
-            for j in range(len(roi[:, 1])):
-                # take line by line, each line is a coordinate couple
-                coord = roi[j, :]
 
-                print(len(training_labels[:,1]))
-                print(len(training_labels[1, :]))
-                if coord[0] >= len(training_labels[:,1]):
-                    coord[0] = len(training_labels[:,1])-1
+def predict_image_budget(img_array, clf, features_func, budget=None, output='labels'):
+    """
+    Segment an image, tiling it if needed to stay within the memory budget
+    """
+    params = features_func.keywords
+    plan = plan_memory(img_array.shape, params, n_classes=len(clf.classes_), budget=budget)
+    return predict_image(img_array, clf, features_func, plan['tile_size'], feature_margin(**params), output)
 
-                if coord[1] >= len(training_labels[1,:]):
-                    coord[1] = len(training_labels[1,:])-1
 
-                training_labels[coord[0], coord[1]] = i + 1
+def export_model(path, clf, features_func):
+    """
+    Save a fitted classifier with its feature settings
+    :param path: destination file (.joblib)
+    """
+    joblib.dump({'version': 1, 'clf': clf, 'feature_params': dict(features_func.keywords)}, path, compress=3)
 
 
-    return training_labels
+def load_model(path):
+    """
+    Load a model saved by export_model
+    :return: classifier, features function
+    """
+    model = joblib.load(path)
+    return model['clf'], get_features_func(**model['feature_params'])
 
 
-def weka_segment(img_array, training_labels, sigma_min=1, sigma_max=16,edges=False, texture=True):
+def weka_segment(img_array, training_labels, sigma_min=1, sigma_max=16,edges=False, texture=True, banks=(), features=None,
+                 classifier=DEFAULT_CLASSIFIER, clf_params=None, memory_budget=None):
     # Build an array of labels for training the segmentation.
     # Here we use rectangles but visualization libraries such as plotly
     # (and napari?) can be used to draw a mask on the image.
@@ -70,14 +420,412 @@ def weka_segment(img_array, training_labels, sigma_min=1, sigma_max=16,edges=Fal
     training_labels[150:200, 720:860] = 4
     """
 
-    features_func = partial(feature.multiscale_basic_features,
-                            intensity=True, edges=edges, texture=texture,
-                            sigma_min=sigma_min, sigma_max=sigma_max,
-                            channel_axis=-1)
-    features = features_func(img_array)
-    clf = RandomForestClassifier(n_estimators=50, n_jobs=-1,
-                                 max_depth=10, max_samples=0.05)
+    features_func = get_features_func(sigma_min=sigma_min, sigma_max=sigma_max,
+                                      edges=edges, texture=texture, banks=banks)
+    clf = make_classifier(classifier, **(clf_params or {}))
+
+    if features is None:
+        params = features_func.keywords
+        n_classes = len(np.unique(training_labels)) - 1
+        plan = plan_memory(img_array.shape, params, n_classes=n_classes, budget=memory_budget)
+        if plan['tile_size'] is not None:
+            print(f"image processed by tiles of {plan['tile_size']} px, "
+                  f"estimated peak memory {plan['peak_bytes'] / 1e9:.2f} GB")
+            margin = feature_margin(**params)
+            X, y = training_data_tiled(img_array, training_labels, features_func, plan['tile_size'], margin)
+            clf.fit(X, y)
+            result = predict_image(img_array, clf, features_func, plan['tile_size'], margin)
+            return clf, features_func, result
+        features = features_func(img_array)
+
     clf = future.fit_segmenter(training_labels, features, clf)
     result = future.predict_segmenter(features, clf)
 
-    return clf, features_func, result
\ No newline at end of file
+    return clf, features_func, result
+
+
+def _resident_memory():
+    """
+    Resident memory of the process, in bytes (None if unknown)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        # not available on Windows and macOS
+        return None
+
+
+def _measured_fit(clf, X, y, interval=0.005):
+    """
+    Fit a classifier and measure its time and peak memory. The resident memory of the process is
+    sampled, as the buffers allocated by compiled code (e.g. tree nodes) are not seen by tracemalloc.
+    Where it is not available, memory is traced during a separate fit, as tracing slows down the
+    Python allocations and would bias the fit time.
+    :return: fit time [s], peak memory increase [bytes]
+    """
+    base = _resident_memory()
+    if base is None:
+        tracemalloc.start()
+        try:
+            clf.fit(X, y)
+            _, fit_peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        t0 = time.perf_counter()
+        clf.fit(X, y)
+        return time.perf_counter() - t0, fit_peak
+
+    peak = [base]
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(interval):
+            peak[0] = max(peak[0], _resident_memory())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        t0 = time.perf_counter()
+        clf.fit(X, y)
+        fit_time = time.perf_counter() - t0
+    finally:
+        stop.set()
+        sampler.join()
+    return fit_time, max(peak[0], _resident_memory()) - base
+
+
+def benchmark_classifiers(training_labels, features, names=None, test_size=0.2, block_size=64, seed=0):
+    """
+    Fit each classifier on the current labels and measure its cost
+    :param training_labels: label array (0 = unlabelled)
+    :param features: features array (H x W x F)
+    :param names: classifiers to test (default: all the registry)
+    :param test_size: part of the labelled pixels kept to measure the accuracy, taken by spatial blocks
+        (see spatial_folds) so that the accuracy is not inflated by neighbouring pixels
+    :return: list of dict, one per classifier
+    """
+    mask = training_labels > 0
+    X = features[mask]
+    y = training_labels[mask].ravel()
+    folds = spatial_folds(training_labels, n_folds=max(2, int(round(1 / test_size))), block_size=block_size,
+                          seed=seed)
+    train, test = folds != 0, folds == 0
+    X_train, X_test, y_train, y_test = X[train], X[test], y[train], y[test]
+    X_all = features.reshape(-1, features.shape[-1])
+
+    reports = []
+    for name in names or CLASSIFIERS:
+        clf = make_classifier(name)
+
+        fit_time, fit_peak = _measured_fit(clf, X_train, y_train)
+
+        accuracy = clf.score(X_test, y_test)
+
+        t0 = time.perf_counter()
+        clf.predict(X_all)
+        predict_time = time.perf_counter() - t0
+
+        reports.append({'name': name,
+                        'accuracy': accuracy,
+                        'fit_time': fit_time,
+                        'pixels_per_s': X_all.shape[0] / predict_time,
+                        'fit_memory_mb': fit_peak / 1e6,
+                        'model_size_mb': len(pickle.dumps(clf)) / 1e6})
+        print(f'{name}: {reports[-1]}')
+
+    return reports
+
+
+def spatial_folds(training_labels, n_folds=3, block_size=64, seed=0):
+    """
+    Split the labelled pixels in folds made of whole spatial blocks, so that neighbouring
+    (strongly correlated) pixels are never used both for training and validation.
+    :param training_labels: label array (0 = unlabelled)
+    :return: fold index of each labelled pixel (in the order of training_labels[mask])
+    """
+    rows, cols = np.nonzero(training_labels > 0)
+    n_block_cols = training_labels.shape[1] // block_size + 1
+    block_ids = (rows // block_size) * n_block_cols + cols // block_size
+
+    blocks = np.unique(block_ids)
+    if len(blocks) < n_folds:
+        raise ValueError(f'Labels cover only {len(blocks)} blocks of {block_size} px, '
+                         f'spread the ROIs over the image or use less than {n_folds} folds')
+    rng = np.random.default_rng(seed)
+    fold_of_block = np.empty(len(blocks), dtype=int)
+    fold_of_block[rng.permutation(len(blocks))] = np.arange(len(blocks)) % n_folds
+
+    return fold_of_block[np.searchsorted(blocks, block_ids)]
+
+
+def _evaluate_config(training_labels, folds, features, classifier, clf_params):
+    """
+    :return: cross-validated accuracy, classifier fitted on all the labels
+    """
+    mask = training_labels > 0
+    X = features[mask]
+    y = training_labels[mask].ravel()
+
+    scores = []
+    for k in np.unique(folds):
+        train, test = folds != k, folds == k
+        if len(np.unique(y[train])) < 2:
+            continue
+        clf = make_classifier(classifier, **clf_params)
+        clf.fit(X[train], y[train])
+        scores.append(clf.score(X[test], y[test]))
+
+    clf = make_classifier(classifier, **clf_params)
+    clf.fit(X, y)
+    return float(np.mean(scores)) if scores else float('nan'), clf
+
+
+def _predict_time(clf, features, n_predict=200_000):
+    """
+    Prediction time of one megapixel, measured on a sample of the image
+    """
+    X_all = features.reshape(-1, features.shape[-1])
+    sample = X_all[np.random.default_rng(0).integers(0, len(X_all), min(n_predict, len(X_all)))]
+    t0 = time.perf_counter()
+    clf.predict(sample)
+    return (time.perf_counter() - t0) / len(sample) * 1e6
+
+
+def pareto_front(results):
+    """
+    Flag the results for which no other setting is both faster and more accurate
+    :param results: list of dict with 'accuracy' and 'seconds_per_mp' keys
+    :return: the Pareto-optimal results, from the fastest to the most accurate
+    """
+    front = []
+    best_accuracy = -np.inf
+    for r in sorted(results, key=lambda r: (r['seconds_per_mp'], -r['accuracy'])):
+        r['pareto'] = r['accuracy'] > best_accuracy
+        if r['pareto']:
+            best_accuracy = r['accuracy']
+            front.append(r)
+    return front
+
+
+def autotune(img_array, training_labels, search_space=None, classifier=DEFAULT_CLASSIFIER,
+             n_folds=3, block_size=64, n_jobs=None, budget=None):
+    """
+    Spatially-blocked cross-validation of all the settings of the search space,
+    measuring both the accuracy and the time needed to segment one megapixel.
+    :param search_space: dict parameter -> list of values (default: SEARCH_SPACE).
+    Keys of DEFAULT_FEATURE_PARAMS are feature settings, the others are classifier parameters.
+    :param budget: memory budget in bytes, the features of the whole image must fit in it
+    :return: (all results, Pareto-optimal results)
+    """
+    search_space = search_space or SEARCH_SPACE
+    folds = spatial_folds(training_labels, n_folds=n_folds, block_size=block_size)
+
+    feat_keys = [k for k in search_space if k in FEATURE_KEYS]
+    clf_keys = [k for k in search_space if k not in FEATURE_KEYS]
+    feat_grid = [dict(zip(feat_keys, v)) for v in itertools.product(*(search_space[k] for k in feat_keys))]
+    clf_grid = [dict(zip(clf_keys, v)) for v in itertools.product(*(search_space[k] for k in clf_keys))]
+
+    # parallelism is done across settings, not inside the classifiers
+    n_jobs = n_jobs or os.cpu_count()
+    deployed_n_jobs = CLASSIFIERS[classifier][1].get('n_jobs')
+    if deployed_n_jobs is not None:
+        clf_grid = [dict(p, n_jobs=1) for p in clf_grid]
+    n_mp = img_array.shape[0] * img_array.shape[1] / 1e6
+
+    results = []
+    for feat_params in feat_grid:
+        params = dict(DEFAULT_FEATURE_PARAMS, **feat_params)
+        plan = plan_memory(img_array.shape, params, n_classes=len(np.unique(training_labels)) - 1, budget=budget)
+        if plan['tile_size'] is not None:
+            raise MemoryBudgetError('Features of the whole image do not fit in the memory budget, '
+                                    'tune the parameters on a crop of the image')
+        t0 = time.perf_counter()
+        features = get_features_func(**params)(img_array)
+        feature_time = time.perf_counter() - t0
+
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [executor.submit(_evaluate_config, training_labels, folds, features, classifier, clf_params)
+                       for clf_params in clf_grid]
+            fitted = [fut.result() for fut in futures]
+
+        # prediction is timed once the pool is idle, one setting at a time, with the
+        # parallelism used for inference, so that the speeds can be compared
+        for clf_params, (accuracy, clf) in zip(clf_grid, fitted):
+            if deployed_n_jobs is not None:
+                clf.set_params(n_jobs=deployed_n_jobs)
+            clf_params = {k: v for k, v in clf_params.items() if k != 'n_jobs'}
+            r = {'accuracy': accuracy,
+                 'seconds_per_mp': feature_time / n_mp + _predict_time(clf, features),
+                 'feature_params': params,
+                 'clf_params': clf_params}
+            print(f'autotune: {r}')
+            results.append(r)
+        del features, fitted
+
+    return results, pareto_front(results)
+
+
+def refit_segmenter(clf, training_labels, features, refresh=0.2):
+    """
+    Retrain a fitted forest by replacing only part of its trees.
+    The oldest trees are dropped and new ones are grown on the current labels, so that
+    the trees that are kept (and everything cached from them) stay valid. Faster than a full
+    retrain, but the new labels only influence the votes of the new trees.
+    :param clf: fitted RandomForestClassifier or ExtraTreesClassifier (other classifiers are fully retrained)
+    :param training_labels: label array (0 = unlabelled)
+    :param features: features array, as returned by the features function
+    :param refresh: fraction of the trees to regrow
+    :return: the updated classifier
+    """
+    mask = training_labels > 0
+    classes = np.unique(training_labels[mask])
+
+    if not is_forest(clf) or not hasattr(clf, 'estimators_') or not np.array_equal(classes, clf.classes_):
+        # not a forest, or a category was added or removed: the old trees cannot be reused
+        return future.fit_segmenter(training_labels, features, clf)
+
+    n_trees = clf.n_estimators
+    n_new = max(1, int(round(n_trees * refresh)))
+
+    clf.set_params(warm_start=True, n_estimators=n_trees + n_new)
+    clf.fit(features[mask], training_labels[mask].ravel())
+    clf.estimators_ = clf.estimators_[n_new:]
+    clf.set_params(warm_start=False, n_estimators=n_trees)
+
+    return clf
+
+
+def tree_signature(tree):
+    """
+    Fingerprint of a fitted decision tree, used to know if cached predictions are still valid
+    """
+    if not hasattr(tree, 'tree_'):
+        # not a tree (gradient boosting, linear model, ...): fingerprint the whole estimator
+        return zlib.crc32(pickle.dumps(tree))
+    t = tree.tree_
+    crc = zlib.crc32(t.feature.tobytes())
+    crc = zlib.crc32(t.threshold.tobytes(), crc)
+    crc = zlib.crc32(t.value.tobytes(), crc)
+    return crc
+
+
+class UncertaintyMap:
+    """
+    Per-pixel confidence and entropy of a fitted forest, cached by tile.
+    After a retrain, only the tiles whose labels changed are fully recomputed. For the others,
+    the contribution of the removed trees is subtracted and the one of the new trees is added.
+    """
+    def __init__(self, tile_size=256):
+        self.tile_size = tile_size
+        self.shape = None
+        self.n_classes = 0
+        self.trees = {}  # signature -> trees currently included in the cache (identical trees share it)
+        self.proba_sums = {}  # tile -> sum of the per-tree probabilities
+        self.label_crcs = {}  # tile -> crc of the labels in the tile
+        self.confidence = None
+        self.entropy = None
+
+    def reset(self):
+        self.shape = None
+        self.trees = {}
+        self.proba_sums = {}
+        self.label_crcs = {}
+        self.confidence = None
+        self.entropy = None
+
+    def tiles(self):
+        h, w = self.shape
+        for y in range(0, h, self.tile_size):
+            for x in range(0, w, self.tile_size):
+                yield y, x
+
+    def tile_slice(self, tile):
+        y, x = tile
+        return slice(y, y + self.tile_size), slice(x, x + self.tile_size)
+
+    def update(self, clf, features, training_labels):
+        """
+        Refresh the maps after (re)training
+        :param clf: fitted forest
+        :param features: features array (H x W x F)
+        :param training_labels: label array (H x W)
+        :return: list of the tiles that were recomputed
+        """
+        n_classes = len(clf.classes_)
+        if self.shape != features.shape[:2] or self.n_classes != n_classes:
+            self.reset()
+            self.shape = features.shape[:2]
+            self.n_classes = n_classes
+            self.confidence = np.ones(self.shape, dtype=np.float32)
+            self.entropy = np.zeros(self.shape, dtype=np.float32)
+
+        # estimators that are not forests of decision trees are cached as a single member
+        members = getattr(clf, 'estimators_', None)
+        if members is None or not all(hasattr(tree, 'tree_') for tree in members):
+            members = [clf]
+        new_trees = {}
+        for tree in members:
+            new_trees.setdefault(tree_signature(tree), []).append(tree)
+        # identical trees give the same probabilities: only their number matters
+        added = [tree for sig, trees in new_trees.items() for tree in trees[len(self.trees.get(sig, [])):]]
+        removed = [tree for sig, trees in self.trees.items() for tree in trees[len(new_trees.get(sig, [])):]]
+        # above this, recomputing everything is cheaper than patching the sums
+        full_refresh = len(added) + len(removed) >= len(members)
+
+        changed = []
+        for tile in self.tiles():
+            sl = self.tile_slice(tile)
+            crc = zlib.crc32(np.ascontiguousarray(training_labels[sl]).tobytes())
+            labels_changed = self.label_crcs.get(tile) != crc
+
+            if not labels_changed and not added and not removed and tile in self.proba_sums:
+                continue
+
+            tile_feat = features[sl]
+            X = tile_feat.reshape(-1, tile_feat.shape[-1]).astype(np.float32)
+
+            if labels_changed or full_refresh or tile not in self.proba_sums:
+                sums = self._tree_sum(members, X)
+            else:
+                sums = self.proba_sums[tile]
+                sums += self._tree_sum(added, X)
+                sums -= self._tree_sum(removed, X)
+
+            self.proba_sums[tile] = sums
+            self.label_crcs[tile] = crc
+            self._write_tile(tile, sums / len(members))
+            changed.append(tile)
+
+        self.trees = new_trees
+        return changed
+
+    def _tree_sum(self, trees, X):
+        sums = np.zeros((X.shape[0], self.n_classes), dtype=np.float32)
+        for tree in trees:
+            if hasattr(tree, 'tree_'):
+                sums += tree.predict_proba(X, check_input=False)
+            else:
+                sums += tree.predict_proba(X)
+        return sums
+
+    def _write_tile(self, tile, proba):
+        sl = self.tile_slice(tile)
+        h, w = self.confidence[sl].shape
+        proba = np.clip(proba, 0, 1)
+        self.confidence[sl] = proba.max(axis=1).reshape(h, w)
+
+        # entropy normalized to [0, 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ent = -np.nansum(proba * np.log(proba), axis=1)
+        if self.n_classes > 1:
+            ent /= np.log(self.n_classes)
+        self.entropy[sl] = ent.reshape(h, w)
+
+    def lowest_confidence(self, fraction=0.1):
+        """
+        Mask of the least confident pixels
+        :param fraction: part of the image to highlight
+        """
+        threshold = np.quantile(self.confidence, fraction)
+        return self.confidence <= threshold
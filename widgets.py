@@ -120,36 +120,158 @@ def loadUi(uifile, baseinstance=None, customWidgets=None,
     return widget
 
 
-def QPixmapFromItem(item):
+def ArrayToQPixmap(rgba):
     """
-    Transform a QGraphicsitem into a Pixmap
-    :param item: QGraphicsItem
+    Transform a RGBA numpy array (uint8) into a Pixmap
+    :param rgba: numpy array, shape (h, w, 4)
     :return: QPixmap
     """
-    pixmap = QPixmap(item.boundingRect().size().toSize())
-    pixmap.fill(Qt.transparent)
-    painter = QPainter(pixmap)
-    # this line seems to be needed for all items except of a LineItem...
-    painter.translate(-item.boundingRect().x(), -item.boundingRect().y())
-    painter.setRenderHint(QPainter.Antialiasing, True)
-    opt = QStyleOptionGraphicsItem()
-    item.paint(painter, opt)  # here in some cases the self is needed
-    return pixmap
-
-def QPixmapToArray(pixmap):
-    ## Get the size of the current pixmap
-    size = pixmap.size()
-    h = size.width()
-    w = size.height()
-
-    ## Get the QImage Item and convert it to a byte string
-    qimg = pixmap.toImage()
-    byte_str = qimg.bits().tobytes()
-
-    ## Using the np.frombuffer function to convert the byte string into an np array
-    img = np.frombuffer(byte_str, dtype=np.uint8).reshape((w,h,4))
-
-    return img
+    rgba = np.ascontiguousarray(rgba, dtype=np.uint8)
+    h, w = rgba.shape[:2]
+    qimg = QImage(rgba.data, w, h, 4 * w, QImage.Format_RGBA8888)
+    # copy, so that the pixmap does not depend on the numpy buffer
+    return QPixmap.fromImage(qimg.copy())
+
+def rasterize_path(path, pen):
+    """
+    Pixels covered by a stroke of the pen along a path
+    :param path: QPainterPath, in image coordinates
+    :return: numpy array (n, 2) of (row, col) coordinates
+    """
+    margin = pen.widthF()
+    rect = path.boundingRect().adjusted(-margin, -margin, margin, margin)
+    x0, y0 = int(np.floor(rect.left())), int(np.floor(rect.top()))
+    w = int(np.ceil(rect.right())) - x0 + 1
+    h = int(np.ceil(rect.bottom())) - y0 + 1
+
+    qimg = QImage(w, h, QImage.Format_RGBA8888)
+    qimg.fill(Qt.transparent)
+    painter = QPainter(qimg)
+    painter.translate(-x0, -y0)
+    # opaque, so that dark colors are not lost
+    stroke_pen = QPen(pen)
+    stroke_pen.setColor(QColor(0, 0, 0))
+    painter.strokePath(path, stroke_pen)
+    painter.end()
+
+    rgba = np.frombuffer(qimg.constBits(), dtype=np.uint8).reshape(h, qimg.bytesPerLine())[:, :4 * w]
+    rows, cols = np.nonzero(rgba.reshape(h, w, 4)[..., 3])
+    return np.column_stack((rows + y0, cols + x0))
+
+
+class LabelOverlay(QGraphicsItem):
+    """
+    Label mask (image coordinates, 0 = unlabelled) shown over the photo.
+    The mask is drawn by tiles: only the visible tiles are painted, and a new stroke only
+    rebuilds the tiles it touches, whatever the number of strokes already drawn.
+    """
+    def __init__(self, tile_size=256, alpha=120):
+        super().__init__()
+        self.tile_size = tile_size
+        self.alpha = alpha
+        self.mask = None
+        self.lut = np.zeros((256, 4), dtype=np.uint8)
+        self._tiles = {}  # (tile row, tile col) -> QImage
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+
+    def boundingRect(self):
+        if self.mask is None:
+            return QRectF()
+        h, w = self.mask.shape
+        return QRectF(0, 0, w, h)
+
+    def reset(self, shape=None):
+        """
+        :param shape: (h, w) of the image, None when there is no image
+        """
+        self.prepareGeometryChange()
+        self.mask = np.zeros(shape, dtype=np.uint8) if shape is not None else None
+        self._tiles.clear()
+        self.update()
+
+    def set_mask(self, labels):
+        self.prepareGeometryChange()
+        self.mask = np.array(labels, dtype=np.uint8)
+        self._tiles.clear()
+        self.update()
+
+    def set_colors(self, colors):
+        """
+        :param colors: QColor of each category (label i + 1)
+        """
+        lut = np.zeros((256, 4), dtype=np.uint8)
+        for i, color in enumerate(colors):
+            lut[i + 1] = (color.red(), color.green(), color.blue(), self.alpha)
+        if not np.array_equal(lut, self.lut):
+            self.lut = lut
+            self._tiles.clear()
+            self.update()
+
+    def clear(self):
+        if self.mask is not None:
+            self.mask[:] = 0
+            self._tiles.clear()
+            self.update()
+
+    def fill_rect(self, rect, label):
+        """
+        :param rect: QRectF, in image coordinates
+        """
+        h, w = self.mask.shape
+        rect = rect.normalized()
+        top, bottom = max(int(rect.top()), 0), min(int(rect.bottom()), h)
+        left, right = max(int(rect.left()), 0), min(int(rect.right()), w)
+        if top < bottom and left < right:
+            self.mask[top:bottom, left:right] = label
+            self.update_region(top, left, bottom, right)
+
+    def fill_pixels(self, coords, label):
+        """
+        :param coords: numpy array (n, 2) of (row, col) coordinates
+        :return: bounding box (top, left, bottom, right) of the pixels set, None if none is in the image
+        """
+        h, w = self.mask.shape
+        inside = (coords[:, 0] >= 0) & (coords[:, 0] < h) & (coords[:, 1] >= 0) & (coords[:, 1] < w)
+        rows, cols = coords[inside, 0], coords[inside, 1]
+        if not len(rows):
+            return None
+        self.mask[rows, cols] = label
+        bbox = int(rows.min()), int(cols.min()), int(rows.max()) + 1, int(cols.max()) + 1
+        self.update_region(*bbox)
+        return bbox
+
+    def update_region(self, top, left, bottom, right):
+        """
+        Rebuild the tiles of a modified region of the mask, and repaint it
+        """
+        ts = self.tile_size
+        for ty in range(top // ts, (bottom - 1) // ts + 1):
+            for tx in range(left // ts, (right - 1) // ts + 1):
+                self._tiles.pop((ty, tx), None)
+        self.update(QRectF(left, top, right - left, bottom - top))
+
+    def _tile(self, ty, tx):
+        qimg = self._tiles.get((ty, tx))
+        if qimg is None:
+            ts = self.tile_size
+            rgba = np.ascontiguousarray(self.lut[self.mask[ty * ts:(ty + 1) * ts, tx * ts:(tx + 1) * ts]])
+            h, w = rgba.shape[:2]
+            # copy, so that the image does not depend on the numpy buffer
+            qimg = QImage(rgba.data, w, h, 4 * w, QImage.Format_RGBA8888).copy()
+            self._tiles[(ty, tx)] = qimg
+        return qimg
+
+    def paint(self, painter, option, widget=None):
+        if self.mask is None:
+            return
+        exposed = option.exposedRect.intersected(self.boundingRect())
+        if exposed.isEmpty():
+            return
+        ts = self.tile_size
+        for ty in range(int(exposed.top()) // ts, int(np.ceil(exposed.bottom()) - 1) // ts + 1):
+            for tx in range(int(exposed.left()) // ts, int(np.ceil(exposed.right()) - 1) // ts + 1):
+                painter.drawImage(QPointF(tx * ts, ty * ts), self._tile(ty, tx))
+
 
 class PhotoViewer(QGraphicsView):
     photoClicked = Signal(QPoint)
@@ -163,6 +285,12 @@ class PhotoViewer(QGraphicsView):
         self._scene = QGraphicsScene(self)
         self._photo = QGraphicsPixmapItem()
         self._scene.addItem(self._photo)
+        self._labels = LabelOverlay()
+        self._labels.setZValue(0.5)
+        self._scene.addItem(self._labels)
+        self._uncertainty = QGraphicsPixmapItem()
+        self._uncertainty.setZValue(1)
+        self._scene.addItem(self._uncertainty)
         self.setScene(self._scene)
         self.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
         self.setResizeAnchor(QGraphicsView.AnchorUnderMouse)
@@ -222,12 +350,48 @@ class PhotoViewer(QGraphicsView):
             self._zoom = 0
 
     def clean_scene(self):
-        for item in self._scene.items():
-            print(type(item))
-            if isinstance(item, QGraphicsPathItem):
-                self._scene.removeItem(item)
-            elif isinstance(item, QGraphicsRectItem):
+        # the ROIs are only kept in the label mask, except a stroke being drawn
+        for item in (self._current_rect_item, self._current_path_item):
+            if item is not None:
                 self._scene.removeItem(item)
+        self._current_rect_item = None
+        self._current_path_item = None
+        self._labels.clear()
+
+    def set_labels(self, labels=None, colors=None):
+        """
+        Show a label mask over the photo (e.g. the labels of a reopened project); new ROIs are drawn into it
+        :param labels: label array (h, w), 0 = unlabelled
+        :param colors: QColor of each category (label i + 1)
+        """
+        if labels is None:
+            self._labels.clear()
+            return
+        self._labels.set_mask(labels)
+        if colors is not None:
+            self._labels.set_colors(colors)
+
+    def get_labels(self):
+        """
+        :return: copy of the label mask of the ROIs (h, w), 0 = unlabelled
+        """
+        return None if self._labels.mask is None else self._labels.mask.copy()
+
+    def set_uncertainty(self, confidence=None, mask=None, color=(255, 0, 255)):
+        """
+        Highlight the regions where the model is the least confident
+        :param confidence: confidence map (h, w), between 0 and 1
+        :param mask: pixels to highlight
+        """
+        if confidence is None:
+            self._uncertainty.setPixmap(QPixmap())
+            return
+
+        rgba = np.zeros(confidence.shape + (4,), dtype=np.uint8)
+        rgba[..., :3] = color
+        alpha = 80 + 175 * (1 - confidence)
+        rgba[..., 3] = np.where(mask, alpha, 0).astype(np.uint8)
+        self._uncertainty.setPixmap(ArrayToQPixmap(rgba))
 
     def setPhoto(self, pixmap=None):
         self._zoom = 0
@@ -239,6 +403,8 @@ class PhotoViewer(QGraphicsView):
             self._empty = True
             self.setDragMode(QGraphicsView.NoDrag)
             self._photo.setPixmap(QPixmap())
+        self._labels.reset(None if self._empty else (pixmap.height(), pixmap.width()))
+        self._uncertainty.setPixmap(QPixmap())
         self.fitInView()
 
     def change_to_brush_cursor(self):
@@ -266,11 +432,10 @@ class PhotoViewer(QGraphicsView):
     def set_cat(self, cat, categories):
         self.active_category = cat
         self.categories = categories
+        self._labels.set_colors([c.color for c in categories])
 
-    def redraw_all_items(self):
-        for cat in self.categories:
-            for item in cat.item_list_rect:
-                self._scene.addItem(item)
+    def active_label(self):
+        return self.categories.index(self.active_category) + 1
 
     # mouse events
     def wheelEvent(self, event):
@@ -294,7 +459,8 @@ class PhotoViewer(QGraphicsView):
             self._current_rect_item = QGraphicsRectItem()
             self._current_rect_item.setFlag(QGraphicsItem.ItemIsSelectable)
             self._current_rect_item.setPen(self.pen)
-            self.active_category.item_list_rect.append(self._current_rect_item)
+            # above the label and uncertainty overlays
+            self._current_rect_item.setZValue(2)
             self._scene.addItem(self._current_rect_item)
             self.origin = self.mapToScene(event.pos())
             r = QRectF(self.origin, self.origin)
@@ -309,8 +475,7 @@ class PhotoViewer(QGraphicsView):
             self._current_path_item = QGraphicsPathItem()
             self._current_path_item.setPath(self._current_path)
             self._current_path_item.setPen(self.pen)
-
-            self.active_category.item_list_brush.append(self._current_path_item)
+            self._current_path_item.setZValue(2)
             self._scene.addItem(self._current_path_item)
 
         else:
@@ -339,6 +504,9 @@ class PhotoViewer(QGraphicsView):
             if self._current_rect_item is not None:
                 coord = self.get_coord(self._current_rect_item)
                 print(self.active_category)
+                # the temporary item is replaced by its pixels in the label mask
+                self._labels.fill_rect(self._current_rect_item.rect(), self.active_label())
+                self._scene.removeItem(self._current_rect_item)
                 self.active_category.roi_list_rect.append(coord)
                 self.active_category.nb_roi_rect += 1
                 self.endDrawing_rect.emit(self.active_category.nb_roi_rect)
@@ -348,24 +516,13 @@ class PhotoViewer(QGraphicsView):
 
         elif self.painting:
             if self._current_path_item is not None:
-                # create pixmap from item
-                pixmap = QPixmapFromItem(self._current_path_item)
-                image = QPixmapToArray(pixmap)
-                gray = np.dot(image[...,:3], [0.2989, 0.5870, 0.1140])
-
-                coords = np.column_stack(np.where(gray > 2))
-
-                bb_rect = self._current_path_item.sceneBoundingRect()
-                top_left = bb_rect.topLeft()
-
-                limit_row = int(top_left.x())
-                limit_col = int(top_left.y())
-                print(f'limits = {limit_row}, {limit_col}')
-
-                coords[:, 0] += limit_col
-                coords[:, 1] += limit_row
+                # the temporary item is replaced by its pixels in the label mask
+                coords = rasterize_path(self._current_path, self.pen)
+                bbox = self._labels.fill_pixels(coords, self.active_label())
+                self._scene.removeItem(self._current_path_item)
 
-                self.active_category.roi_list_brush.append(coords)
+                # the pixels are only kept in the label mask
+                self.active_category.roi_list_brush.append(bbox)
                 self.active_category.nb_roi_brush += 1
                 self.endDrawing_brush.emit(self.active_category.nb_roi_brush)
                 print('brush ROI added')